@@ -1,15 +1,60 @@
-from flask import Flask, render_template, request, session, redirect, jsonify
+from flask import Flask, render_template, request, session, redirect, jsonify, g, Response, stream_with_context, \
+                  make_response, has_app_context
 from functools import wraps
+from contextlib import contextmanager
 from config import params
-import os, sqlite3, unidecode, json, random
+import os, sqlite3, unidecode, json, click, logging, hmac, bisect, random, threading
+import assets, autocomplete, bulk, cache, catalog, changelog, database, fulltext, ingredient_index, metrics, migrations
+import maintenance, plan, sampling, similarity, writer
 
 jinja_params =  {
     "path": params["path"],
 }
 
-app = Flask(__name__, static_url_path="/static")
-app.config["TEMPLATES_AUTO_RELOAD"] = True
-app.secret_key = os.urandom(16)
+production_assets = params.get("production_assets", False)
+
+# In production, static files are served by the static route below, from memory
+app = Flask(__name__, static_url_path="/static", static_folder=None if production_assets else "static")
+# Templates are reloaded when edited, unless in production where they are all compiled at startup
+app.config["TEMPLATES_AUTO_RELOAD"] = not production_assets
+if params.get("secret_key"):
+    app.secret_key = params["secret_key"]
+else:
+    # Sessions won't survive a restart, nor be shared by several worker processes
+    logging.getLogger(__name__).warning("No secret_key in config.py, using a random one.")
+    app.secret_key = os.urandom(16)
+
+pool = database.create_pool(params)
+ingredient_meals = ingredient_index.IngredientIndex()
+ingredient_names = autocomplete.PrefixIndex()
+similar_meals = similarity.SimilarityIndex()
+meal_catalog = catalog.MealCatalog() if params.get("meal_catalog") else None
+response_cache = cache.ResponseCache(params.get("response_cache_size", 256))
+generation = cache.GenerationTracker()
+request_metrics = metrics.Registry(params.get("metrics_slow_query_ms", 100)) if params.get("metrics") else None
+
+with pool.connection() as conn:
+    migrations.migrate(conn)
+    changelog.compact(conn.cursor(), params.get("change_log_size", changelog.KEEP))
+    fulltext_enabled = params.get("fulltext_search", True) and fulltext.setup(conn)
+    generation.check(conn.cursor())
+
+if production_assets:
+    static_files = assets.StaticFiles(os.path.join(app.root_path, "static"))
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    app.jinja_env.globals["asset_url"] = static_files.url
+
+    @app.route("/static/<path:filename>")
+    def static(filename):
+        """ Static files by their hashed name, cached for good, or by their name, revalidated """
+        return static_files.response(filename, request) or ("Not found", 404)
+
+    @app.after_request
+    def compress_response(response):
+        return assets.compress(response, request, params.get("compress_level", 6), params.get("compress_min_size", 1024))
+else:
+    app.jinja_env.globals["asset_url"] = lambda filename: filename
 
 return_template = {
     "msg": "some info about what happend, is ok if everything went well",
@@ -26,11 +71,12 @@ def error(msg, code, http_code=400):
     }), http_code
 
 
-def respond(data):
+def respond(data, **extra):
     return jsonify({
         "msg": "ok",
         "code": 0,
-        "data": data
+        "data": data,
+        **extra
     }), 200
 
 
@@ -39,7 +85,199 @@ def template(*args, **kwargs):
 
 
 def db_cursor():
-    return sqlite3.connect(params["db_path"], isolation_level=None).cursor()
+    """ Returns a cursor on the connection of the current request,
+    the connection is taken from the pool on first use and given back at teardown
+    """
+    if "db" not in g:
+        g.db = pool.acquire()
+    if "sql" in g:
+        return g.db.cursor(g.sql.cursor)
+    return g.db.cursor()
+
+
+@contextmanager
+def write_transaction(cur):
+    """ database.transaction() for the request handlers, the handler updates the in memory
+    indexes itself so its own write must not be taken for a write of another process
+    """
+    with database.transaction(cur):
+        before = generation.read(cur)
+        yield cur
+        after = generation.read(cur)
+    generation.own_write(before, after)
+    if after // changelog.COMPACT_EVERY != before // changelog.COMPACT_EVERY:
+        compaction_due.set()
+
+
+# Compaction runs on the writer thread once the writes that made it due are committed and answered
+compaction_due = threading.Event()
+
+
+def compact_changes(cur):
+    """ Compacts the change log if due, a failure is only logged, the writes are already committed """
+    if not compaction_due.is_set():
+        return
+    compaction_due.clear()
+    try:
+        changelog.compact(cur, params.get("change_log_size", changelog.KEEP))
+    except sqlite3.Error:
+        app.logger.exception("Couldn't compact the change log")
+
+
+# A write committed after its request gave up on it was never applied to the in memory state
+meal_writer = writer.create_writer(pool, params, write_transaction, after_commit=compact_changes,
+                                   on_abandoned=lambda: invalidate_indexes())
+
+
+def write(function):
+    """ Runs function(cursor) in a write transaction and returns its result, or raises its exception.
+    Writes go through the writer thread, which commits those of concurrent requests together,
+    unless the request already has a transaction open, like a batch, they then run in it.
+    Outside of a request, like in the maintenance thread, writes always go through the writer thread.
+    """
+    if not has_app_context():
+        return meal_writer.submit(function)
+    if "db" in g and g.db.in_transaction:
+        cur = db_cursor()
+        with write_transaction(cur):
+            return function(cur)
+    stats = g.get("sql")
+    if stats is not None:
+        # Statements run on the writer's connection count for this request, the shared commit doesn't
+        return meal_writer.submit(lambda cur: function(cur.connection.cursor(stats.cursor)))
+    return meal_writer.submit(function)
+
+
+@app.errorhandler(TimeoutError)
+def write_timeout(e):
+    """ The writer thread didn't commit the write of the request in time, it may still do it later """
+    return error("{0} Check the data before retrying.".format(e), -1, 503)
+
+
+# Jobs write through write(), inside a write batch they run in its transaction instead of waiting on its lock
+maintenance_jobs = maintenance.Maintenance(pool, params.get("maintenance") or {}, write,
+                                           on_change=lambda: invalidate_indexes())
+
+if maintenance_jobs.intervals:
+    @app.before_request
+    def start_maintenance():
+        # Started by the first request, once per worker process, jobs are claimed so only one runs each
+        maintenance_jobs.ensure_started()
+
+
+if request_metrics is not None:
+    # Registered only when enabled, so that disabled metrics cost nothing
+    @app.before_request
+    def start_metrics():
+        g.sql = request_metrics.start()
+
+    @app.after_request
+    def status_metrics(response):
+        g.status = response.status_code
+        return response
+
+    @app.teardown_request
+    def record_metrics(exception):
+        # Runs once a streamed response is fully sent
+        stats = g.pop("sql", None)
+        if stats is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            request_metrics.record(route, request.method, g.pop("status", 500), stats)
+
+
+@app.before_request
+def sync_generation():
+    """ Drops the in memory state made stale by writes from other processes,
+    the sub-requests of a read only batch leave it alone, they read an older snapshot
+    """
+    if request.path.startswith("/api/") and not g.get("batch_snapshot") and generation.check(db_cursor()):
+        invalidate_indexes()
+
+
+def loaded_index(index, cur):
+    """ Returns index, loaded. In a read only batch the shared index isn't loaded from the batch's
+    snapshot, older than the writes it would then be kept up to date with, the batch loads its own copy.
+    """
+    if not g.get("batch_snapshot") or index.loaded:
+        index.ensure_loaded(cur)
+        return index
+    copies = g.setdefault("batch_indexes", {})
+    if index not in copies:
+        copies[index] = type(index)()
+        copies[index].load(cur)
+    return copies[index]
+
+
+def invalidate_indexes():
+    """ Drops every response cached and every in memory index, they are rebuilt on next use """
+    response_cache.bump()
+    ingredient_meals.invalidate()
+    ingredient_names.invalidate()
+    similar_meals.invalidate()
+    if meal_catalog is not None:
+        meal_catalog.invalidate()
+
+
+@app.teardown_appcontext
+def release_db(exception):
+    conn = g.pop("db", None)
+    if conn is not None:
+        pool.release(conn)
+
+
+# One row per meal, ingredients are aggregated so that a whole result set is hydrated in a single query.
+# Conditions go between the select and MEAL_GROUP_BY.
+MEAL_COLUMNS = "meals.id, title, description, meal_entry, meal_time, season, preparation_time, cook_time"
+MEAL_SELECT = "SELECT " + MEAL_COLUMNS + ", group_concat(meal_ingredients.ingredient_id) FROM meals \
+               LEFT JOIN meal_ingredients ON meal_ingredients.meal_id = meals.id "
+MEAL_SELECT_EXPANDED = "SELECT " + MEAL_COLUMNS + ", json_group_array(json_object('id', ingredients.id, \
+                        'name', ingredients.name)) FILTER (WHERE ingredients.id IS NOT NULL) FROM meals \
+                        LEFT JOIN meal_ingredients ON meal_ingredients.meal_id = meals.id \
+                        LEFT JOIN ingredients ON ingredients.id = meal_ingredients.ingredient_id "
+MEAL_GROUP_BY = " GROUP BY meals.id "
+
+
+def meal_select(expand=False):
+    return MEAL_SELECT_EXPANDED if expand else MEAL_SELECT
+
+
+def format_meal(meal, expand=False):
+    """ Turns a row from meal_select() into a meal object,
+    ingredients are ids, or {id, name} objects when expanded
+    """
+    if expand:
+        ingredients = json.loads(meal[8])
+    else:
+        ingredients = [int(x) for x in meal[8].split(",")] if meal[8] else []
+
+    return {
+        "id": meal[0],
+        "title": meal[1],
+        "description": meal[2],
+        "meal_entry": meal[3],
+        "meal_time": meal[4],
+        "season": meal[5],
+        "preparation_time": meal[6],
+        "cook_time": meal[7],
+        "ingredients": ingredients
+    }
+
+
+def fetch_meals(cur, ids, expand=False):
+    """ Hydrates the given meal ids, in the same order """
+    result = cur.execute(meal_select(expand) + " WHERE meals.id IN (SELECT value FROM json_each(?)) "
+                         + MEAL_GROUP_BY, [json.dumps(ids)]).fetchall()
+    result = {meal[0]: meal for meal in result}
+    return [format_meal(result[meal_id], expand) for meal_id in ids if meal_id in result]
+
+
+def parse_expand(value):
+    """ Returns True if ingredients should be expanded, None if value is invalid """
+    if not value:
+        return False
+    if value != "ingredients":
+        return None
+    return True
 
 
 def login_required(f):
@@ -51,6 +289,45 @@ def login_required(f):
     return decorated_function
 
 
+def cached(f):
+    """ Serves GET requests from the response cache, with a strong ETag so that clients
+    can revalidate and get a 304. Any successful write empties the cache.
+    Random picks and streamed responses are never cached, nor are the sub-requests of a read only
+    batch, whose snapshot may be older or newer than the cached responses.
+    """
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if g.get("batch_snapshot"):
+            return f(*args, **kwargs)
+
+        if request.method != "GET":
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                response_cache.bump()
+            return response
+
+        if request.args.get("mode") == "random":
+            return f(*args, **kwargs)
+
+        key = response_cache.key(request.path, request.args)
+        entry = response_cache.get(key)
+        if entry is None:
+            generation = response_cache.generation
+            response = make_response(f(*args, **kwargs))
+            if response.status_code != 200 or response.is_streamed:
+                return response
+            body = response.get_data()
+            entry = (cache.etag(body), body, response.mimetype)
+            response_cache.put(key, generation, entry)
+
+        tag, body, mimetype = entry
+        response = Response(body, mimetype=mimetype)
+        response.set_etag(tag)
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response.make_conditional(request)
+    return decorated_function
+
+
 @app.route("/")
 @login_required
 def index():
@@ -69,11 +346,116 @@ def login():
             return template("login.html", login_failed=True)
 
 
-@app.route("/api/meals/<int:id>", methods=["GET", "DELETE"])
+def parse_meal_form(form, partial=False):
+    """ Validates the meal fields sent to POST /api/meals and PUT, PATCH /api/meals/<id>,
+    returns (data, None) or (None, error response), see POST /api/meals for the error codes.
+    Missing fields get their default value, unless partial is set: they are then left out of data.
+    """
+    # Retrieve input
+    data = {
+        "title": form.get("title"),
+        "description": form.get("description"),
+        "meal_entry": form.get("meal_entry"),
+        "meal_time": form.get("meal_time"),
+        "season": form.get("season"),
+        "preparation_time": form.get("preparation_time"),
+        "cook_time": form.get("cook_time"),
+        "ingredients": form.get("ingredients")
+    }
+
+    if data["title"]:
+        data["title"] = unidecode.unidecode(data["title"])
+    elif not partial or "title" in form:
+        return None, error("Malformed request, missing parameter title.", 1)
+    
+    if not data["description"]:
+        data["description"] = ""
+    data["description"] = unidecode.unidecode(data["description"])
+    
+    if not data["meal_entry"]:
+        data["meal_entry"] = 1
+    else:
+        try:
+            data["meal_entry"] = int(data["meal_entry"])
+        except ValueError:
+            return None, error("Invalid meal entry. Should be 0, 1 or 2.", 3)
+
+        if not data["meal_entry"] in {0, 1, 2}:
+            return None, error("Invalid meal entry. Should be 0, 1 or 2.", 3)
+
+    if not data["meal_time"]:
+        data["meal_time"] = -1
+    else:
+        try:
+            data["meal_time"] = int(data["meal_time"])
+        except ValueError:
+            return None, error("Invalid meal time. Should be -1, 0 or 1.", 4)
+
+        if not data["meal_time"] in {-1, 0, 1}:
+            return None, error("Invalid meal time. Should be -1, 0 or 1.", 4)
+
+    if not data["season"]:
+        data["season"] = -1
+    else:
+        try:
+            data["season"] = int(data["season"])
+        except ValueError:
+            return None, error("Invalid season. Should be -1, 0, 1, 2 or 3.", 5)
+
+        if not data["season"] in {-1 ,0, 1, 2, 3}:
+            return None, error("Invalid season. Should be -1, 0, 1, 2 or 3.", 5)
+
+    if not data["preparation_time"]:
+        data["preparation_time"] = None
+    else:
+        try:
+            data["preparation_time"] = int(data["preparation_time"])
+        except ValueError:
+            return None, error("Invalid preparation time, should be a positive number.", 6)
+
+        if data["preparation_time"] < 0:
+            return None, error("Invalid preparation time, should be a positive number.", 6)
+
+    if not data["cook_time"]:
+        data["cook_time"] = None
+    else:
+        try:
+            data["cook_time"] = int(data["cook_time"])
+        except ValueError:
+            return None, error("Invalid cook time, should be a positive number", 7)
+
+        if data["cook_time"] < 0:
+            return None, error("Invalid cook time, should be a positive number", 7)
+
+    if not data["ingredients"]:
+        data["ingredients"] = []
+    else:
+        try:
+            data["ingredients"] = json.loads(data["ingredients"])
+        except json.JSONDecodeError:
+            return None, error("Malformed request, couldn't parse parameters.", 8)
+        
+        try:
+            # Duplicates are dropped, a meal links to an ingredient once
+            data["ingredients"] = list(dict.fromkeys(int(ingredient) for ingredient in data["ingredients"]))
+        except (TypeError, ValueError):
+            return None, error("Ingredient ids must be integers.", 9)
+
+    if partial:
+        data = {key: value for key, value in data.items() if key in form}
+
+    return data, None
+
+
+@app.route("/api/meals/<int:id>", methods=["GET", "PUT", "PATCH", "DELETE"])
 @login_required
+@cached
 def meal(id):
     if request.method == "GET":
         """ Returns the meal with the given id
+        parameters:
+            args:
+                expand (optional) -> ingredients: ingredients are returned as {id, name} objects
         returns:
             id               -> id of the meal
             title            -> title of the meal
@@ -86,29 +468,68 @@ def meal(id):
             ingredients      -> array of ids of the ingredients of the meal
         error:
             1 -> resource does not exist
+            2 -> invalid expand value
         """
-        cur = db_cursor()
-        meal = cur.execute("SELECT * FROM meals WHERE id=?", [id]).fetchall()
+        expand = parse_expand(request.args.get("expand"))
+        if expand is None:
+            return error("Invalid expand value, should be ingredients.", 2)
+
+        meal = db_cursor().execute(meal_select(expand) + " WHERE meals.id=? " + MEAL_GROUP_BY, [id]).fetchall()
         if not meal:
             return error("Resource does not exist", 1)
 
-        meal = meal[0]
+        return respond(format_meal(meal[0], expand))
+
 
-        ingredients = cur.execute("SELECT id FROM ingredients INNER JOIN meal_ingredients \
-                                   ON ingredients.id=meal_ingredients.ingredient_id WHERE meal_id=?",
-                                  [id]).fetchall()
-        ingredients = [x[0] for x in ingredients]
+    elif request.method in ("PUT", "PATCH"):
+        """ Updates the meal with the given id
+        PUT replaces the meal, it takes the same parameters as POST /api/meals,
+        PATCH only changes the parameters given.
+        Only the ingredients added or removed are written.
+        returns:
+            meal_id -> id of the meal
+        errors:
+            1 to 9 -> see POST /api/meals
+            10     -> resource does not exist
+        """
+        data, failure = parse_meal_form(request.form, partial=request.method == "PATCH")
+        if failure:
+            return failure
+
+        fields = [key for key in data if key != "ingredients"]
+
+        def update(cur):
+            if not cur.execute("SELECT id FROM meals WHERE id=?", [id]).fetchone():
+                return False
+
+            if fields:
+                cur.execute("UPDATE meals SET " + ", ".join(key + "=?" for key in fields) + " WHERE id=?",
+                            [data[key] for key in fields] + [id])
+
+            if "ingredients" in data:
+                current = {x[0] for x in cur.execute("SELECT ingredient_id FROM meal_ingredients WHERE meal_id=?",
+                                                     [id])}
+                wanted = set(data["ingredients"])
+                cur.executemany("DELETE FROM meal_ingredients WHERE meal_id=? AND ingredient_id=?",
+                                [[id, ingredient_id] for ingredient_id in current - wanted])
+                cur.executemany("INSERT INTO meal_ingredients (meal_id, ingredient_id) VALUES (?,?)",
+                                [[id, ingredient_id] for ingredient_id in wanted - current])
+            return True
+
+        try:
+            if not write(update):
+                return error("Resource does not exist", 10)
+        except sqlite3.IntegrityError:
+            return error("Meal with given title already exists.", 2)
+
+        if "ingredients" in data:
+            ingredient_meals.add_meal(id, data["ingredients"])
+            similar_meals.add_meal(id, data["ingredients"])
+        if meal_catalog is not None:
+            meal_catalog.update(id, data)
 
         return respond({
-            "id": meal[0],
-            "title": meal[1],
-            "description": meal[2],
-            "meal_entry": meal[3],
-            "meal_time": meal[4],
-            "season": meal[5],
-            "preparation_time": meal[6],
-            "cook_time": meal[7],
-            "ingredients": ingredients
+            "meal_id": id
         })
 
 
@@ -116,13 +537,78 @@ def meal(id):
         """ Deletes the meal with the given id
         Does not return an error if the meal doesn't exist
         """
-        db_cursor().execute("DELETE FROM meals WHERE id=?", [id])
-        db_cursor().execute("DELETE FROM meal_ingredients WHERE meal_id=?", [id])
+        def delete(cur):
+            cur.execute("DELETE FROM meals WHERE id=?", [id])
+            cur.execute("DELETE FROM meal_ingredients WHERE meal_id=?", [id])
+
+        write(delete)
+        ingredient_meals.remove_meal(id)
+        similar_meals.remove_meal(id)
+        if meal_catalog is not None:
+            meal_catalog.remove(id)
         return respond(None)
 
 
+@app.route("/api/meals/<int:id>/similar", methods=["GET"])
+@login_required
+@cached
+def similar(id):
+    """ Returns the meals whose ingredients are the most like those of the meal with the given id
+    parameters:
+        args:
+            k      (int) (optional, default: 10)          -> number of meals, between 1 and 100
+            mode         (optional, default: approximate) -> approximate: looks only at the meals likely to be
+                                                                         similar, fast on large catalogs
+                                                             exact: compares the meal to every other one
+            expand       (optional)                       -> ingredients: ingredients are returned as
+                                                             {id, name} objects instead of ids
+    returns:
+        an array of at most k meal objects, most similar first, with one more key
+            similarity -> Jaccard similarity of the ingredients, between 0 and 1
+        meals sharing no ingredient are never returned, nor are any for a meal without ingredients
+    errors:
+        1 -> resource does not exist
+        2 -> invalid k
+        3 -> invalid mode
+        4 -> invalid expand value
+    """
+    k = request.args.get("k") or 10
+    try:
+        k = int(k)
+    except ValueError:
+        return error("Invalid k, should be a number between 1 and 100.", 2)
+
+    if not 1 <= k <= 100:
+        return error("Invalid k, should be a number between 1 and 100.", 2)
+
+    mode = request.args.get("mode") or "approximate"
+    if not mode in ("approximate", "exact"):
+        return error("Invalid mode: {0}, should be approximate or exact.".format(mode), 3)
+
+    expand = parse_expand(request.args.get("expand"))
+    if expand is None:
+        return error("Invalid expand value, should be ingredients.", 4)
+
+    cur = db_cursor()
+    if not cur.execute("SELECT id FROM meals WHERE id=?", [id]).fetchone():
+        return error("Resource does not exist", 1)
+
+    similarity_index = loaded_index(similar_meals, cur)
+    if mode == "exact":
+        neighbours = similarity_index.similar_exact(id, k)
+    else:
+        neighbours = similarity_index.similar(id, k)
+
+    response = fetch_meals(cur, [meal_id for meal_id, _ in neighbours], expand)
+    scores = dict(neighbours)
+    for meal in response:
+        meal["similarity"] = round(scores[meal["id"]], 4)
+    return respond(response)
+
+
 @app.route("/api/meals", methods=["GET", "POST"])
 @login_required
+@cached
 def meals():
     if request.method == "GET":
         """ Search for meals
@@ -130,7 +616,17 @@ def meals():
             args:
                 mode                 (optional, default: search) -> search: search for meals using parameters
                                                                     random: get a random meal with given parameters
-                title                        (optional)                                            
+                                                                    pantry: get the meals that can be cooked with
+                                                                            the ingredients given, best first
+                count                (int)   (optional)              -> random mode: number of distinct meals to pick,
+                                                                        between 1 and 100
+                                                                        pantry mode: number of meals returned,
+                                                                        between 1 and 100, default 20
+                weight                       (optional)              -> random mode: fresh: favour meals that were not
+                                                                                           suggested recently
+                                                                                    season: favour meals of the current season
+                title                        (optional)              -> words of the title or description, the last
+                                                                        one can be a prefix, best matches come first
                 meal_entry           (int)   (optional)              -> 0: before, 1: main course, 2: dessert
                 meal_time            (int)   (optional)              -> -1: any, 0: lunch, 1: dinner
                 season               (int)   (optional)              -> -1: any, 0: spring, 1: summer, 2: autumn, 3: winter
@@ -138,14 +634,34 @@ def meals():
                 cook_time_max        (int)   (optional)              -> maximum cooking time, 0 will be considered as any
                 total_time_max       (int)   (optional)              -> maximum time for preparation_time + cook_time,
                                                                         0 will be considered as any
-                ingredients          (array) (optional)              -> array of ids of the ingredients of the meal
+                ingredients          (array) (optional)              -> array of ids of the ingredients of the meal,
+                                                                        every one of them must be used
+                                                                        pantry mode: the ingredients available
+                ingredients_any      (array) (optional)              -> array of ingredient ids, at least one must be used
+                ingredients_none     (array) (optional)              -> array of ingredient ids, none must be used
+                expand                       (optional)              -> ingredients: ingredients are returned as
+                                                                        {id, name} objects instead of ids
+                limit                (int)   (optional)              -> search mode: page size, between 1 and 1000
+                after                (int)   (optional)              -> search mode: id of the last meal of the
+                                                                        previous page, as given by next
+                format                       (optional, default: json) -> search mode: json or ndjson, ndjson streams
+                                                                          one meal object per line
         returns:
             search mode:
-                an array of meal objects matching the query
+                an array of meal objects matching the query, ordered by relevance when searching a title
+                when limit, after or format=ndjson are given, meals are ordered by id and the
+                response has a next key: the value of after for the next page, null on the last page.
+                ndjson responses have no envelope, the next page starts after the id of the last line
             random mode:
-                a single meal object matching the query
+                a single meal object matching the query,
+                or an array of at most count meal objects if count is given
+            pantry mode:
+                an array of meal objects with two more keys, best first
+                    score   -> fraction of the ingredients of the meal that are available
+                    missing -> number of ingredients of the meal that are not available
         errors:
             1  -> Invalid search mode
+            2  -> No meal matches the query (random mode without count)
             3  -> Invalid meal entry
             4  -> Invalid meal time
             5  -> Invalid season
@@ -154,13 +670,56 @@ def meals():
             8  -> Invalid maximum total time, should be a positive number
             9  -> Malformed request, couldn't parse parameters
             10 -> Ingredient ids must be integers
+            11 -> Invalid expand value
+            12 -> Invalid count
+            13 -> Invalid weight
+            14 -> Invalid limit
+            15 -> Invalid after, should be a meal id
+            16 -> Invalid format
         """
         # Parse request
+        cur = db_cursor()
+
         mode = request.args.get("mode")
         if not mode:
-            mode == "search"
-        elif not mode in ("search", "random"):
-            return error("Invalid search mode: {0}, should be search or random.".format(mode), 1)
+            mode = "search"
+        elif not mode in ("search", "random", "pantry"):
+            return error("Invalid search mode: {0}, should be search, random or pantry.".format(mode), 1)
+
+        count = request.args.get("count")
+        if count:
+            try:
+                count = int(count)
+            except ValueError:
+                return error("Invalid count, should be a number between 1 and 100.", 12)
+
+            if not 1 <= count <= 100:
+                return error("Invalid count, should be a number between 1 and 100.", 12)
+
+        weight = request.args.get("weight")
+        if weight and not weight in sampling.WEIGHTS:
+            return error("Invalid weight: {0}, should be fresh or season.".format(weight), 13)
+
+        limit = request.args.get("limit")
+        if limit:
+            try:
+                limit = int(limit)
+            except ValueError:
+                return error("Invalid limit, should be a number between 1 and 1000.", 14)
+
+            if not 1 <= limit <= 1000:
+                return error("Invalid limit, should be a number between 1 and 1000.", 14)
+
+        after = request.args.get("after")
+        if after:
+            try:
+                after = int(after)
+            except ValueError:
+                return error("Invalid after, should be a meal id.", 15)
+
+        output_format = request.args.get("format") or "json"
+        if not output_format in ("json", "ndjson"):
+            return error("Invalid format: {0}, should be json or ndjson.".format(output_format), 16)
 
         data = {
             "title": request.args.get("title"),
@@ -170,15 +729,28 @@ def meals():
             "preparation_time_max": request.args.get("preparation_time_max"),
             "cook_time_max": request.args.get("cook_time_max"),
             "total_time_max": request.args.get("total_time_max"),
-            "ingredients": request.args.get("ingredients")
+            "ingredients": request.args.get("ingredients"),
+            "ingredients_any": request.args.get("ingredients_any"),
+            "ingredients_none": request.args.get("ingredients_none")
         }
+
+        expand = parse_expand(request.args.get("expand"))
+        if expand is None:
+            return error("Invalid expand value, should be ingredients.", 11)
         
         # Build SQL query
-        query_base = "SELECT id, title, description, meal_entry, meal_time, season, preparation_time, cook_time FROM meals "
+        query_base = meal_select(expand)
         query_conditions = []
         arguments = []
 
-        if data["title"]:
+        # Attribute filters, evaluated by the catalog when enabled, by sqlite otherwise
+        filters = {}
+
+        title_ranking = None
+        if data["title"] and fulltext_enabled:
+            # Given to sqlite with the other id lists, below
+            title_ranking = fulltext.search(cur, data["title"])
+        elif data["title"]:
             query_conditions.append(" title LIKE ? ")
             arguments.append("%" + "%".join(unidecode.unidecode(data["title"]).split()) + "%")
         
@@ -191,8 +763,7 @@ def meals():
             if not data["meal_entry"] in {0, 1, 2}:
                 return error("Invalid meal entry. Should be 0, 1 or 2.", 3)
 
-            query_conditions.append(" meal_entry = ? ")
-            arguments.append(data["meal_entry"])
+            filters["meal_entry"] = data["meal_entry"]
 
         if data["meal_time"]:
             try:
@@ -203,8 +774,7 @@ def meals():
             if not data["meal_time"] in {-1, 0, 1}:
                 return error("Invalid meal time. Should be -1, 0 or 1.", 4)
 
-            query_conditions.append(" meal_time = ? ")
-            arguments.append(data["meal_time"])
+            filters["meal_time"] = data["meal_time"]
 
         if data["season"]:
             try:
@@ -215,8 +785,7 @@ def meals():
             if not data["season"] in {-1 ,0, 1, 2, 3}:
                 return error("Invalid season. Should be -1, 0, 1, 2 or 3.", 5)
             
-            query_conditions.append(" season = ? ")
-            arguments.append(data["season"])
+            filters["season"] = data["season"]
 
         if data["preparation_time_max"]:
             try:
@@ -227,8 +796,7 @@ def meals():
             if data["preparation_time_max"] < 0:
                 return error("Invalid maximum preparation time, should be a positive number.", 6)
             
-            query_conditions.append(" preparation_time <= ? ")
-            arguments.append(data["preparation_time_max"])
+            filters["preparation_time_max"] = data["preparation_time_max"]
 
         if data["cook_time_max"]:
             try:
@@ -239,8 +807,7 @@ def meals():
             if data["cook_time_max"] < 0:
                 return error("Invalid maximum cook time, should be a positive number", 7)
 
-            query_conditions.append(" cook_time <= ? ")
-            arguments.append(data["cook_time_max"])
+            filters["cook_time_max"] = data["cook_time_max"]
 
         if data["total_time_max"]:
             try:
@@ -251,48 +818,137 @@ def meals():
             if data["total_time_max"] < 0:
                 return error("Invalid maximum total time, should be a positive number", 8)
 
-            query_conditions.append(" (cook_time + preparation_time) <= ? ")
-            arguments.append(data["total_time_max"])
+            filters["total_time_max"] = data["total_time_max"]
+
 
+        for key in ("ingredients", "ingredients_any", "ingredients_none"):
+            if not data[key]:
+                data[key] = []
+                continue
 
-        if data["ingredients"]:
             try:
-                data["ingredients"] = json.loads(data["ingredients"])
+                data[key] = json.loads(data[key])
             except json.JSONDecodeError:
                 return error("Malformed request, couldn't parse parameters.", 9)
-            
-            for ingredient in data["ingredients"]:                
-                query_conditions.append(" ? IN (SELECT ingredient_id FROM meal_ingredients WHERE meal_id = meals.id) ")
-                try:
-                    arguments.append(int(ingredient))
-                except ValueError:
-                    return error("Ingredient ids must be integers.", 10)
+
+            try:
+                data[key] = [int(ingredient) for ingredient in data[key]]
+            except (TypeError, ValueError):
+                return error("Ingredient ids must be integers.", 10)
+
+        # Ingredient filters are answered by the inverted index, the matching ids are given to sqlite as a json array
+        all_of = [] if mode == "pantry" else data["ingredients"]
+        postings = ingredient_meals
+        if all_of or data["ingredients_any"] or data["ingredients_none"] or mode == "pantry":
+            postings = loaded_index(ingredient_meals, cur)
+
+        ingredient_matched = None
+        excluded = None
+        if all_of or data["ingredients_any"]:
+            ingredient_matched = postings.match(all_of, data["ingredients_any"], data["ingredients_none"])
+        elif data["ingredients_none"]:
+            excluded = postings.excluded(data["ingredients_none"])
+
+        matched = None
+        if filters and meal_catalog is not None:
+            matched = loaded_index(meal_catalog, cur).filter(filters, ingredient_matched)
+            if excluded is not None:
+                matched = [meal_id for meal_id in matched if meal_id not in excluded]
+                excluded = None
+        else:
+            for name, value in filters.items():
+                query_conditions.append(catalog.SQL_FILTERS[name])
+                arguments.append(value)
+            if ingredient_matched is not None:
+                matched = sorted(ingredient_matched)
+
+        # When the matching ids are known and nothing else filters them, sqlite is only given the ones needed
+        candidates_only = matched is not None and not query_conditions and title_ranking is None
+        paginated = limit or after or output_format == "ndjson"
+        if candidates_only and mode == "search" and paginated:
+            # matched is sorted by id, so is a page
+            matched = matched[bisect.bisect_right(matched, after or 0):]
+            if limit:
+                matched = matched[:limit + 1]
+
+        picked = None
+        if mode == "random" and not weight:
+            # Known id lists are sampled from directly, sqlite only checks the column conditions of the picks
+            candidates = matched
+            if title_ranking is not None:
+                candidates = title_ranking if matched is None else sorted(set(matched).intersection(title_ranking))
+            picked = sampling.sample_meal_ids(cur, query_conditions, arguments, count or 1,
+                                              candidates=candidates, excluded=excluded)
+        else:
+            for ids, operator in ((title_ranking, "IN"), (matched, "IN"), (excluded, "NOT IN")):
+                if ids is not None:
+                    query_conditions.append(" meals.id {0} (SELECT value FROM json_each(?)) ".format(operator))
+                    arguments.append(json.dumps(sorted(ids) if operator == "NOT IN" else ids))
 
         # Query database
-        cur = db_cursor()
-        query_ingredients = "SELECT ingredient_id FROM meal_ingredients WHERE meal_id = ?"
+        if mode == "random":
+            # Pick the ids first, only the winners are read and hydrated
+            if picked is None:
+                picked = sampling.sample_meal_ids(cur, query_conditions, arguments, count or 1, weight)
+            if not picked:
+                if count:
+                    return respond([])
+                return error("No meal matches the query.", 2, 404)
+
+            response = fetch_meals(cur, picked, expand)
+            return respond(response if count else response[0])
+
+        if mode == "pantry":
+            scores = postings.pantry(data["ingredients"])
+            candidates = scores.keys()
+            if query_conditions:
+                query = "SELECT meals.id FROM meals WHERE meals.id IN (SELECT value FROM json_each(?)) AND " \
+                        + " AND ".join(query_conditions)
+                candidates = [x[0] for x in cur.execute(query, [json.dumps(list(scores))] + arguments)]
+
+            response = fetch_meals(cur, postings.top(scores, count or 20, candidates), expand)
+            for meal in response:
+                meal["score"], meal["missing"] = scores[meal["id"]]
+            return respond(response)
+
+        # Keyset pagination, pages are delimited by id so they stay stable while meals are added
+        if after:
+            query_conditions.append(" meals.id > ? ")
+            arguments.append(after)
 
         query_final = query_base 
         if query_conditions:
             query_final += " WHERE " + " AND ".join(query_conditions)
-        
+        query_final += MEAL_GROUP_BY
+        if paginated:
+            query_final += " ORDER BY meals.id "
+        if limit:
+            # One more row tells whether there is a next page
+            query_final += " LIMIT ? "
+            arguments.append(limit + 1 if output_format == "json" else limit)
+
+        if output_format == "ndjson":
+            # Rows are encoded as they are read, the result set is never held in memory
+            def stream():
+                for meal in cur.execute(query_final, arguments):
+                    yield json.dumps(format_meal(meal, expand)) + "\n"
+            return Response(stream_with_context(stream()), mimetype="application/x-ndjson")
+
         result = cur.execute(query_final, arguments).fetchall()
 
-        #  Format response and send
-        response = [{
-            "id": meal[0],
-            "title": meal[1],
-            "description": meal[2],
-            "meal_entry": meal[3],
-            "meal_time": meal[4],
-            "season": meal[5],
-            "preparation_time": meal[6],
-            "cook_time": meal[7],
-            "ingredients": [x[0] for x in cur.execute(query_ingredients, [meal[0]]).fetchall()]
-        } for meal in result]
+        if paginated:
+            next_after = None
+            if limit and len(result) > limit:
+                result = result[:limit]
+                next_after = result[-1][0]
+            return respond([format_meal(meal, expand) for meal in result], next=next_after)
 
-        if mode == "random":
-            response = random.choice(response)
+        if title_ranking:
+            rank = {meal_id: i for i, meal_id in enumerate(title_ranking)}
+            result.sort(key=lambda meal: rank[meal[0]])
+
+        #  Format response and send
+        response = [format_meal(meal, expand) for meal in result]
 
         return respond(response)
 
@@ -322,120 +978,245 @@ def meals():
             8 -> Malformed request, couldn't parse parameters
             9 -> Ingredient ids must be integers
         """
-        # Retrieve input
-        data = {
-            "title": request.form.get("title"),
-            "description": request.form.get("description"),
-            "meal_entry": request.form.get("meal_entry"),
-            "meal_time": request.form.get("meal_time"),
-            "season": request.form.get("season"),
-            "preparation_time": request.form.get("preparation_time"),
-            "cook_time": request.form.get("cook_time"),
-            "ingredients": request.form.get("ingredients")
-        }
+        data, failure = parse_meal_form(request.form)
+        if failure:
+            return failure
+
+        # Insert into database, the meal and its ingredients are added together or not at all
+        def insert(cur):
+            cur.execute("INSERT INTO meals (title, description, meal_entry, meal_time, season, preparation_time, \
+                         cook_time) VALUES (?,?,?,?,?,?,?)",
+                        [data["title"], data["description"], data["meal_entry"], data["meal_time"],
+                         data["season"], data["preparation_time"], data["cook_time"]])
+            meal_id = cur.lastrowid
+
+            cur.executemany("INSERT INTO meal_ingredients (meal_id, ingredient_id) VALUES (?,?)",
+                            [[meal_id, ingredient_id] for ingredient_id in data["ingredients"]])
+            return meal_id
+
+        try:
+            meal_id = write(insert)
+        except sqlite3.IntegrityError:
+            # meals.title is unique
+            return error("Meal with given title already exists.", 2)
 
-        if not data["title"]:
-            return error("Malformed request, missing parameter title.", 1)
-        data["title"] = unidecode.unidecode(data["title"])
-        
-        if not data["description"]:
-            data["description"] = ""
-        data["description"] = unidecode.unidecode(data["description"])
-        
-        if not data["meal_entry"]:
-            data["meal_entry"] = 1
-        else:
-            try:
-                data["meal_entry"] = int(data["meal_entry"])
-            except ValueError:
-                return error("Invalid meal entry. Should be 0, 1 or 2.", 3)
+        ingredient_meals.add_meal(meal_id, data["ingredients"])
+        similar_meals.add_meal(meal_id, data["ingredients"])
+        if meal_catalog is not None:
+            meal_catalog.add(meal_id, data)
 
-            if not data["meal_entry"] in {0, 1, 2}:
-                return error("Invalid meal entry. Should be 0, 1 or 2.", 3)
+        return respond({
+            "meal_id": meal_id
+        })
 
-        if not data["meal_time"]:
-            data["meal_time"] = -1
-        else:
-            try:
-                data["meal_time"] = int(data["meal_time"])
-            except ValueError:
-                return error("Invalid meal time. Should be -1, 0 or 1.", 4)
 
-            if not data["meal_time"] in {-1, 0, 1}:
-                return error("Invalid meal time. Should be -1, 0 or 1.", 4)
 
-        if not data["season"]:
-            data["season"] = -1
+@app.route("/api/meals/import", methods=["POST"])
+@login_required
+def meals_import():
+    """ Import meals in bulk, ingredients are given by name and created if needed
+    parameters:
+        body: a JSON array of meals, or one meal per line with the application/x-ndjson content type,
+              see bulk.py for the format of a meal
+    returns:
+        read     -> number of meals read
+        imported -> number of meals added
+        skipped  -> meals not added because a meal with the same title exists
+        errors   -> array of [index, message] for each invalid meal, they are not added
+    errors:
+        1 -> Malformed request, couldn't parse the body
+    """
+    try:
+        if request.mimetype == "application/x-ndjson":
+            meals = bulk.read_ndjson(request.stream)
         else:
-            try:
-                data["season"] = int(data["season"])
-            except ValueError:
-                return error("Invalid season. Should be -1, 0, 1, 2 or 3.", 5)
+            meals = bulk.read_json(request.stream)
+    except (UnicodeDecodeError, ValueError):
+        return error("Malformed request, couldn't parse the body.", 1)
 
-            if not data["season"] in {-1 ,0, 1, 2, 3}:
-                return error("Invalid season. Should be -1, 0, 1, 2 or 3.", 5)
-
-        if not data["preparation_time"]:
-            data["preparation_time"] = None
-        else:
-            try:
-                data["preparation_time"] = int(data["preparation_time"])
-            except ValueError:
-                return error("Invalid preparation time, should be a positive number.", 6)
+    # Each batch is a write of the writer thread, the in memory indexes are rebuilt afterwards
+    report = bulk.import_meals(write, meals)
+    invalidate_indexes()
+    return respond(report)
 
-            if data["preparation_time"] < 0:
-                return error("Invalid preparation time, should be a positive number.", 6)
 
-        if not data["cook_time"]:
-            data["cook_time"] = None
-        else:
+@app.route("/api/meals/export", methods=["GET"])
+@login_required
+def meals_export():
+    """ Export every meal with its ingredient names, in the format /api/meals/import reads
+    parameters:
+        args:
+            format (optional, default: json) -> json: a JSON array, ndjson: one meal per line
+    errors:
+        1 -> Invalid format
+    """
+    output_format = request.args.get("format") or "json"
+    if not output_format in ("json", "ndjson"):
+        return error("Invalid format: {0}, should be json or ndjson.".format(output_format), 1)
+
+    meals = bulk.export_meals(db_cursor())
+    if output_format == "ndjson":
+        response = Response(stream_with_context(bulk.write_ndjson(meals)), mimetype="application/x-ndjson")
+    else:
+        response = Response(stream_with_context(bulk.write_json(meals)), mimetype="application/json")
+    response.headers["Content-Disposition"] = "attachment; filename=meals." + output_format
+    return response
+
+
+@app.route("/api/plan", methods=["GET"])
+@login_required
+def meal_plan():
+    """ Plans the meals of the coming days, without repeating a meal and spreading out ingredients
+    parameters:
+        args:
+            days                 (int)   (optional, default: 7)       -> number of days, between 1 and 28
+            slots                        (optional, default: both)    -> lunch, dinner or both
+            meal_entry           (int)   (optional, default: 1)       -> 0: before, 1: main course, 2: dessert
+            season               (int)   (optional, default: current) -> 0: spring, 1: summer, 2: autumn, 3: winter,
+                                                                         meals of any season are planned too,
+                                                                         -1 plans meals of every season
+            preparation_time_max (int)   (optional)                   -> maximum time to prep, 0 will be considered as any
+            cook_time_max        (int)   (optional)                   -> maximum cooking time, 0 will be considered as any
+            total_time_max       (int)   (optional)                   -> maximum time for preparation_time + cook_time,
+                                                                         0 will be considered as any
+            ingredients_none     (array) (optional)                   -> array of ingredient ids, none must be used
+            expand                       (optional)                   -> ingredients: ingredients are returned as
+                                                                         {id, name} objects instead of ids
+            seed                 (int)   (optional)                   -> the same seed gives the same plan, as long
+                                                                         as the meals don't change
+        meal_time is respected: lunch slots get meals with a meal_time of -1 or 0, dinner slots -1 or 1
+    returns:
+        days          -> array of {day, lunch, dinner} objects, day starting at 1, lunch and dinner being meal objects,
+                         or null when no meal is left for it or the slot wasn't asked for
+        shopping_list -> array of {id, name, count} objects, every ingredient of the plan with the number
+                         of meals using it, by name
+    errors:
+        1 -> Invalid number of days
+        2 -> Invalid slots
+        3 -> Invalid meal entry
+        4 -> Invalid season
+        5 -> Invalid maximum preparation time, should be a positive number
+        6 -> Invalid maximum cook time, should be a positive number
+        7 -> Invalid maximum total time, should be a positive number
+        8 -> Malformed request, couldn't parse parameters
+        9 -> Ingredient ids must be integers
+        10 -> Invalid expand value
+        11 -> Invalid seed
+    """
+    days = request.args.get("days") or 7
+    try:
+        days = int(days)
+    except ValueError:
+        return error("Invalid number of days, should be between 1 and 28.", 1)
+
+    if not 1 <= days <= 28:
+        return error("Invalid number of days, should be between 1 and 28.", 1)
+
+    slot_names = request.args.get("slots") or "both"
+    if not slot_names in ("lunch", "dinner", "both"):
+        return error("Invalid slots: {0}, should be lunch, dinner or both.".format(slot_names), 2)
+    slot_names = list(plan.SLOTS) if slot_names == "both" else [slot_names]
+
+    meal_entry = request.args.get("meal_entry") or 1
+    try:
+        meal_entry = int(meal_entry)
+    except ValueError:
+        return error("Invalid meal entry. Should be 0, 1 or 2.", 3)
+
+    if not meal_entry in {0, 1, 2}:
+        return error("Invalid meal entry. Should be 0, 1 or 2.", 3)
+
+    season = request.args.get("season")
+    if season:
+        try:
+            season = int(season)
+        except ValueError:
+            return error("Invalid season. Should be -1, 0, 1, 2 or 3.", 4)
+
+        if not season in {-1, 0, 1, 2, 3}:
+            return error("Invalid season. Should be -1, 0, 1, 2 or 3.", 4)
+    else:
+        season = sampling.current_season()
+
+    filters = {"meal_entry": meal_entry}
+    for key, code, name in (("preparation_time_max", 5, "preparation time"), ("cook_time_max", 6, "cook time"),
+                            ("total_time_max", 7, "total time")):
+        if request.args.get(key):
             try:
-                data["cook_time"] = int(data["cook_time"])
+                filters[key] = int(request.args.get(key))
             except ValueError:
-                return error("Invalid cook time, should be a positive number", 7)
-
-            if data["cook_time"] < 0:
-                return error("Invalid cook time, should be a positive number", 7)
-
-        if not data["ingredients"]:
-            data["ingredients"] = []
-        else:
-            try:
-                data["ingredients"] = json.loads(data["ingredients"])
-            except json.JSONDecodeError:
-                return error("Malformed request, couldn't parse parameters.", 8)
-            
-            for ingredient in data["ingredients"]:
-                try:
-                    int(ingredient)
-                except ValueError:
-                    return error("Ingredient ids must be integers.", 9)
-
-        # Insert into database
-        cur = db_cursor()
-        is_existing = cur.execute("SELECT id FROM meals WHERE title=?", [data["title"]]).fetchall()
-        if is_existing:
-            return error("Meal with given title already exists.", 2)
-        
-        cur.execute("INSERT INTO meals (title, description, meal_entry, meal_time, season, preparation_time, cook_time) \
-                     VALUES (?,?,?,?,?,?,?)",
-                    [data["title"], data["description"], data["meal_entry"], data["meal_time"],
-                     data["season"], data["preparation_time"], data["cook_time"]])
-
-        meal_id = cur.execute("SELECT id FROM meals WHERE title=?", [data["title"]]).fetchall()[0][0]
-
-        for ingredient_id in data["ingredients"]:
-            cur.execute("INSERT INTO meal_ingredients (meal_id, ingredient_id) VALUES (?,?)",
-                        [meal_id, ingredient_id])
-
-        return respond({
-            "meal_id": meal_id
-        })
-
+                return error("Invalid maximum {0}, should be a positive number.".format(name), code)
+
+            if filters[key] < 0:
+                return error("Invalid maximum {0}, should be a positive number.".format(name), code)
+
+    ingredients_none = []
+    if request.args.get("ingredients_none"):
+        try:
+            ingredients_none = json.loads(request.args.get("ingredients_none"))
+        except json.JSONDecodeError:
+            return error("Malformed request, couldn't parse parameters.", 8)
+
+        try:
+            ingredients_none = [int(ingredient) for ingredient in ingredients_none]
+        except (TypeError, ValueError):
+            return error("Ingredient ids must be integers.", 9)
+
+    expand = parse_expand(request.args.get("expand"))
+    if expand is None:
+        return error("Invalid expand value, should be ingredients.", 10)
+
+    seed = request.args.get("seed") or None
+    if seed:
+        try:
+            seed = int(seed)
+        except ValueError:
+            return error("Invalid seed, should be an integer.", 11)
+
+    # Candidates are only ids and meal times, the planned meals are hydrated at the end
+    cur = db_cursor()
+    query_conditions = [catalog.SQL_FILTERS[name] for name in filters]
+    arguments = list(filters.values())
+    if season != -1:
+        query_conditions.append(" season IN (?, -1) ")
+        arguments.append(season)
+    query_conditions.append(" meal_time IN (-1, " + ", ".join(str(plan.SLOTS[x]) for x in slot_names) + ") ")
+
+    postings = loaded_index(ingredient_meals, cur)
+    if ingredients_none:
+        query_conditions.append(" meals.id NOT IN (SELECT value FROM json_each(?)) ")
+        arguments.append(json.dumps(sorted(postings.excluded(ingredients_none))))
+
+    candidates = cur.execute("SELECT id, meal_time FROM meals WHERE " + " AND ".join(query_conditions),
+                             arguments).fetchall()
+    meal_ingredients = postings.ingredients_of(meal_id for meal_id, _ in candidates)
+
+    slots = [plan.SLOTS[x] for _ in range(days) for x in slot_names]
+    planned = plan.build(candidates, meal_ingredients, slots, random.Random(seed))
+    picked = [meal_id for meal_id in planned if meal_id is not None]
+    sampling.remember(picked)
+
+    meals = {meal["id"]: meal for meal in fetch_meals(cur, picked, expand)}
+    response = []
+    for day in range(days):
+        entry = {"day": day + 1, "lunch": None, "dinner": None}
+        for i, name in enumerate(slot_names):
+            meal_id = planned[day * len(slot_names) + i]
+            entry[name] = meals.get(meal_id)
+        response.append(entry)
+
+    counts = plan.shopping_list(picked, meal_ingredients)
+    names = cur.execute("SELECT id, name FROM ingredients WHERE id IN (SELECT value FROM json_each(?)) ORDER BY name",
+                        [json.dumps(list(counts))]).fetchall()
+    return respond({
+        "days": response,
+        "shopping_list": [{"id": x[0], "name": x[1], "count": counts[x[0]]} for x in names]
+    })
 
 
 @app.route("/api/ingredients", methods=["GET", "POST"])
 @login_required
+@cached
 def ingredients():
     if request.method == "GET":
         """ Get ingredients given some parameters
@@ -445,8 +1226,12 @@ def ingredients():
                                                    many: provide a list of ingredient ids and get 
                                                          the corresponding ingredient objects, no error is returned
                                                          if an invalid id is provided
+                                                   autocomplete: provide the beginning of a name and get the
+                                                                 best matches, prefix matches first
                 q -> search mode: a string, 
                      many mode: an JSON array of ingredient ids (less than a 100 long)  
+                     autocomplete mode: a string
+                limit (int) (optional, default 10) -> autocomplete mode: maximum number of results, at most 50
         returns:
             an array of ingredient objects corresponding to the query
         errors:
@@ -454,17 +1239,30 @@ def ingredients():
             2 -> invalid value for 'mode' 
             3 -> malformed request, couldn't parse it
             4 -> invalid search mode
+            5 -> invalid limit
         """
         cur = db_cursor()
 
         mode = request.args.get("mode")
         if not mode:
             mode = "search"
-        elif not mode in ("search", "many"):
-            return error("Invalid search mode: {0}, should be search or many".format(mode), 4)
+        elif not mode in ("search", "many", "autocomplete"):
+            return error("Invalid search mode: {0}, should be search, many or autocomplete".format(mode), 4)
 
         if request.args.get("q"):
-            if mode == "search":
+            if mode == "autocomplete":
+                limit = request.args.get("limit") or 10
+                try:
+                    limit = int(limit)
+                except ValueError:
+                    return error("Invalid limit, should be a number between 1 and 50.", 5)
+
+                if not 1 <= limit <= 50:
+                    return error("Invalid limit, should be a number between 1 and 50.", 5)
+
+                response_data = loaded_index(ingredient_names, cur).complete(request.args.get("q"), limit)
+
+            elif mode == "search":
                 query = "%" + unidecode.unidecode(request.args.get("q")) + "%"
                 response_data = cur.execute("SELECT * FROM ingredients WHERE name LIKE ?", 
                                             [query]).fetchall()
@@ -502,21 +1300,25 @@ def ingredients():
         else:
             return error("Malformed request, parameter name is required.", 1)
 
-        cur = db_cursor()
-
-        is_existing = cur.execute("SELECT id FROM ingredients WHERE name=?",  [ingredient_name]).fetchall()
-        if not is_existing:
+        def insert(cur):
             cur.execute("INSERT INTO ingredients (name) VALUES(?)", [ingredient_name])
-            ingredient_id = cur.execute("SELECT id FROM ingredients WHERE name=?",  [ingredient_name]).fetchall()[0][0]
-            return respond({
-                    "ingredient_id": ingredient_id 
-            })
-        else:
+            return cur.lastrowid
+
+        try:
+            ingredient_id = write(insert)
+        except sqlite3.IntegrityError:
+            # ingredients.name is unique
             return error("Ingredient exists.", 2)
+
+        ingredient_names.add(ingredient_id, ingredient_name)
+        return respond({
+                "ingredient_id": ingredient_id 
+        })
     
 
 @app.route("/api/ingredients/<int:id>", methods=["GET", "DELETE"])
 @login_required
+@cached
 def ingredient(id):
     if request.method == "GET":
         """ Returns the ingredient with the given id
@@ -541,12 +1343,329 @@ def ingredient(id):
         Does not return an error if the ingredient doesn't exist
         Deletes the ingredient from every meal where it is used
         """
-        cur = db_cursor()
-        cur.execute("DELETE FROM ingredients WHERE id=?", [id])
-        cur.execute("DELETE FROM meal_ingredients WHERE meal_id=?", [id])
+        def delete(cur):
+            cur.execute("DELETE FROM ingredients WHERE id=?", [id])
+            cur.execute("DELETE FROM meal_ingredients WHERE ingredient_id=?", [id])
+
+        write(delete)
+        similar_meals.remove_ingredient(id, ingredient_meals.remove_ingredient(id))
+        ingredient_names.remove(id)
         return respond(None)
 
 
+@app.route("/api/changes", methods=["GET"])
+@login_required
+def changes():
+    """ Lists the changes made to meals and ingredients, to update a copy of them instead of fetching everything
+    parameters:
+        args:
+            since (int) (optional, default: 0) -> seq of the last change already applied, the seq returned
+                                                  by the previous call
+            limit (int) (optional, default: 1000) -> maximum number of changes, between 1 and 1000
+    returns:
+        an array of change objects, oldest first:
+            seq    -> increasing number of the change
+            entity -> meal or ingredient
+            id     -> id of the meal or ingredient
+            op     -> insert, update or delete, inserted or updated entities should be fetched again,
+                      a change to the ingredients of a meal is an update of the meal
+        only the last change of an entity may be kept, a delete can come for an entity never inserted
+        the response has three more keys:
+            seq    -> value of since for the next call
+            more   -> true when there are more changes, the next call should be made right away
+            resync -> true when changes after since were dropped: everything must be fetched again,
+                      then the changes followed from seq
+    errors:
+        1 -> Invalid since, should be a positive number
+        2 -> Invalid limit
+    """
+    since = request.args.get("since") or 0
+    try:
+        since = int(since)
+    except ValueError:
+        return error("Invalid since, should be a positive number.", 1)
+
+    if since < 0:
+        return error("Invalid since, should be a positive number.", 1)
+
+    limit = request.args.get("limit") or 1000
+    try:
+        limit = int(limit)
+    except ValueError:
+        return error("Invalid limit, should be a number between 1 and 1000.", 2)
+
+    if not 1 <= limit <= 1000:
+        return error("Invalid limit, should be a number between 1 and 1000.", 2)
+
+    response, seq, more, resync = changelog.since(db_cursor(), since, limit)
+    return respond(response, seq=seq, more=more, resync=resync)
+
+
+BATCH_MAX_REQUESTS = 50
+BATCH_METHODS = ("GET", "POST", "PUT", "PATCH", "DELETE")
+
+
+@app.route("/api/batch", methods=["POST"])
+@login_required
+def batch():
+    """ Runs several API requests in a single round trip
+    parameters:
+        body: a JSON array of at most 50 sub-requests, run in order, each one an object with
+            method (optional, default: GET) -> GET, POST, PUT, PATCH or DELETE
+            path                            -> path of an API route and its query string,
+                                               like /api/meals/3?expand=ingredients
+            form   (optional)               -> object of the form parameters of a POST, PUT or PATCH
+        Sub-requests share one database connection. When they are all GET they read the same
+        snapshot of the database. Otherwise the batch holds the write lock until it is done, each
+        write is applied on its own and the ones that fail don't undo the others.
+    returns:
+        an array with, for each sub-request, in the same order:
+            status -> HTTP status code of the sub-request
+            body   -> its response, the usual {msg, code, data} object, text if the response isn't JSON,
+                      null if the sub-request failed unexpectedly
+    errors:
+        1 -> Malformed request, the body should be a JSON array of sub-requests
+        2 -> Too many sub-requests
+        3 -> Invalid sub-request
+    """
+    items = request.get_json(silent=True)
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return error("Malformed request, the body should be a JSON array of sub-requests.", 1)
+
+    if len(items) > BATCH_MAX_REQUESTS:
+        return error("Too many sub-requests, at most {0} per batch.".format(BATCH_MAX_REQUESTS), 2)
+
+    for index, item in enumerate(items):
+        path = item.get("path")
+        if isinstance(path, str) and params["path"] and path.startswith(params["path"] + "/api/"):
+            path = item["path"] = path[len(params["path"]):]
+        method = item.setdefault("method", "GET")
+        if not method in BATCH_METHODS or not isinstance(path, str) or not path.startswith("/api/") \
+                or path.split("?")[0].rstrip("/") == "/api/batch" or not isinstance(item.get("form", {}), dict):
+            return error("Invalid sub-request {0}, should have a method and the path of an API route.".format(index), 3)
+
+    cur = db_cursor()
+    # Sub-requests record their own metrics, the ones of the batch are put back afterwards
+    batch_stats = g.pop("sql", None)
+    results = []
+    read_only = all(item["method"] == "GET" for item in items)
+    if read_only:
+        # The generation is checked once, before the snapshot, sub-requests then leave the shared state alone
+        if generation.check(cur):
+            invalidate_indexes()
+        g.batch_snapshot = True
+    cur.execute("BEGIN" if read_only else "BEGIN IMMEDIATE")
+    try:
+        for item in items:
+            with app.test_request_context(item["path"], method=item["method"], data=item.get("form"),
+                                          headers={"Cookie": request.headers.get("Cookie", "")}):
+                try:
+                    response = app.full_dispatch_request()
+                    body = response.get_json() if response.is_json else response.get_data(as_text=True)
+                    results.append({"status": response.status_code, "body": body})
+                except Exception:
+                    app.logger.exception("Sub-request %s %s failed", item["method"], item["path"])
+                    results.append({"status": 500, "body": None})
+    except BaseException:
+        cur.execute("ROLLBACK")
+        raise
+    finally:
+        g.pop("batch_snapshot", None)
+        g.pop("batch_indexes", None)
+        if batch_stats is not None:
+            g.sql = batch_stats
+    cur.execute("COMMIT")
+
+    return respond(results)
+
+
+@app.route("/api/db/stats", methods=["GET"])
+@login_required
+def db_stats():
+    """ Returns the connection pool statistics
+    returns:
+        created  -> connections opened since startup
+        reused   -> number of times an idle connection was handed out again
+        released -> connections given back to the pool
+        closed   -> connections closed because the pool was full or on shutdown
+        in_use   -> connections currently held by requests
+        idle     -> connections waiting in the pool
+        max_idle -> maximum number of idle connections kept
+        cache    -> response cache hits, misses, evictions, entries and data generation
+        writer   -> writes committed by the writer thread: commits, writes, failed writes, queue_depth,
+                    mean_batch and max_batch writes per commit, mean_commit_ms, max_commit_ms and last_commit_ms
+    """
+    return respond({**pool.stats(), "cache": response_cache.stats(), "writer": meal_writer.stats()})
+
+
+# Statistics of /api/db/stats that only go up, exported as counters
+COUNTER_STATS = {"created", "reused", "released", "closed", "hits", "misses", "evictions", "commits", "writes", "failed"}
+
+
+@app.route("/api/metrics", methods=["GET"])
+def metrics_endpoint():
+    """ Request metrics of the process, in the Prometheus text format
+    Requires a session, or the metrics_token of config.py as a bearer token for scrapers
+    returns:
+        meal_ideas_requests_total            -> requests by route, method and status
+        meal_ideas_request_duration_seconds  -> histogram of the wall time of the requests, by route and method
+        meal_ideas_request_sql_statements    -> histogram of the SQL statements run per request, those of
+                                                its writes included, their commit is in meal_ideas_writer_*
+        meal_ideas_request_sql_seconds       -> histogram of the time spent in sqlite per request
+        meal_ideas_request_sql_rows          -> histogram of the rows read per request
+        meal_ideas_slow_queries_total        -> statements slower than metrics_slow_query_ms
+        meal_ideas_db_pool_*, meal_ideas_response_cache_*, meal_ideas_writer_* -> see /api/db/stats, the
+                                                statistics that only go up are counters, suffixed with _total
+    errors:
+        1 -> not authenticated
+        2 -> metrics are disabled
+    """
+    token = params.get("metrics_token")
+    authorization = request.headers.get("Authorization", "")
+    if not session.get("is_logged_in") and not (token and hmac.compare_digest(authorization.encode(), ("Bearer " + token).encode())):
+        return error("Authentication required.", 1, 401)
+    if request_metrics is None:
+        return error("Metrics are disabled, set metrics in config.py.", 2, 404)
+
+    gauges = {}
+    counters = {}
+    for prefix, stats in (("meal_ideas_db_pool_", pool.stats()), ("meal_ideas_response_cache_", response_cache.stats()),
+                          ("meal_ideas_writer_", meal_writer.stats())):
+        for key, value in stats.items():
+            if key in COUNTER_STATS:
+                counters[prefix + key + "_total"] = ("See /api/db/stats.", value)
+            else:
+                gauges[prefix + key] = ("See /api/db/stats.", value)
+    return Response(request_metrics.render(gauges, counters), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/api/maintenance", methods=["GET", "POST"])
+@login_required
+def maintenance_endpoint():
+    if request.method == "GET":
+        """ Returns the maintenance jobs scheduled in this process and the report of their last run
+        returns:
+            scheduled -> object of the jobs run on a schedule, with their interval in hours
+            last      -> object of the report of the last run of each job by this process:
+                job      -> backup, dump, orphans, analyze or vacuum
+                finished -> date and time the job ended
+                seconds  -> how long it took
+                error    -> message, if the job failed
+                and, depending on the job:
+                path, bytes, removed -> backup file written, its size and the old backups deleted
+                directory, committed -> where the dump was written, whether it was committed to git
+                deleted, batches     -> orphan links deleted and the number of transactions it took
+                freed_pages, skipped -> pages given back to the file system, why the vacuum didn't run
+        """
+        return respond(maintenance_jobs.stats())
+
+    if request.method == "POST":
+        """ Runs a maintenance job now, see maintenance.py
+        parameters:
+            form:
+                job -> backup, dump, orphans, analyze or vacuum, backup and dump need the
+                       backup_dir and dump_dir of the maintenance entry of config.py
+        returns:
+            the report of the job, see GET
+        errors:
+            1 -> Invalid job
+            2 -> The job failed
+        """
+        job = request.form.get("job", "")
+        if not maintenance_jobs.configured(job):
+            return error("Invalid job, should be one of {0}, backup and dump need a directory in config.py.".format(
+                ", ".join(maintenance.JOBS)), 1)
+
+        report = maintenance_jobs.run(job)
+        if "error" in report:
+            return error("The job failed: {0}".format(report["error"]), 2, 500)
+        return respond(report)
+
+
+@app.cli.command("maintenance")
+@click.argument("job", type=click.Choice(maintenance.JOBS))
+def maintenance_command(job):
+    """ Runs a maintenance job now """
+    if not maintenance_jobs.configured(job):
+        raise click.UsageError("{0} needs {0}_dir in the maintenance entry of config.py.".format(job))
+    report = maintenance_jobs.run(job)
+    click.echo(json.dumps(report, indent=4))
+    if "error" in report:
+        raise SystemExit(1)
+
+
+@app.cli.command("vacuum")
+def vacuum_command():
+    """ Rebuilds the database in incremental auto_vacuum mode, for the vacuum job,
+    writes are blocked while it runs
+    """
+    with pool.connection() as conn:
+        maintenance.vacuum_full(conn)
+    click.echo("Database vacuumed.")
+
+
+@app.cli.command("rebuild-fulltext")
+def rebuild_fulltext():
+    """ Rebuilds the full text index of the meals """
+    with pool.connection() as conn:
+        if not fulltext.setup(conn):
+            click.echo("FTS5 is not available in this sqlite build.")
+            return
+        fulltext.rebuild(conn)
+    click.echo("Full text index rebuilt.")
+
+
+@app.cli.command("check-catalog")
+@click.option("--samples", default=200, show_default=True, help="Random filter combinations to compare.")
+@click.option("--seed", type=int, help="Seed of the random filters.")
+def check_catalog_command(samples, seed):
+    """ Compares the results of the meal catalog to those of sqlite """
+    with pool.connection() as conn:
+        mismatches = catalog.check(conn.cursor(), catalog.MealCatalog(), samples, seed)
+    for filters, found, expected in mismatches:
+        click.echo("{0}: catalog found {1} meals, sqlite {2}".format(json.dumps(filters), len(found), len(expected)))
+    click.echo("{0} of {1} filter combinations differ.".format(len(mismatches), samples))
+    if mismatches:
+        raise SystemExit(1)
+
+
+@app.cli.command("import-meals")
+@click.argument("file", type=click.File("rb"))
+@click.option("--ndjson", is_flag=True, help="One meal per line instead of a JSON array.")
+@click.option("--batch-size", default=bulk.BATCH_SIZE, show_default=True, help="Meals per transaction.")
+def import_meals_command(file, ndjson, batch_size):
+    """ Imports meals from FILE, - for stdin """
+    meals = bulk.read_ndjson(file) if ndjson or file.name.endswith(".ndjson") else bulk.read_json(file)
+
+    def progress(report):
+        click.echo("{read} read, {imported} imported, {skipped} skipped, {0} invalid".format(
+            len(report["errors"]), **report), err=True)
+
+    with pool.connection() as conn:
+        cur = conn.cursor()
+
+        def write_batch(function):
+            with database.transaction(cur):
+                return function(cur)
+
+        report = bulk.import_meals(write_batch, meals, batch_size, progress)
+        changelog.compact(conn.cursor(), params.get("change_log_size", changelog.KEEP))
+    for index, message in report["errors"]:
+        click.echo("Meal {0}: {1}".format(index, message), err=True)
+    click.echo("Done.", err=True)
+
+
+@app.cli.command("export-meals")
+@click.argument("file", type=click.File("w"), default="-")
+@click.option("--ndjson", is_flag=True, help="One meal per line instead of a JSON array.")
+def export_meals_command(file, ndjson):
+    """ Exports every meal to FILE, stdout by default """
+    with pool.connection() as conn:
+        meals = bulk.export_meals(conn.cursor())
+        for chunk in (bulk.write_ndjson(meals) if ndjson or file.name.endswith(".ndjson") else bulk.write_json(meals)):
+            file.write(chunk)
+
+
 @app.route("/logout", methods=["GET", "POST"])
 @login_required
 def logout():
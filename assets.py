@@ -0,0 +1,140 @@
+""" Production delivery of the static files and compression of the responses
+Static files are read once at startup, each one is given a name with a hash of its content,
+style.<hash>.css, that templates link to through asset_url() and that is served with a cache
+lifetime of a year: a new version of the file is a new name. Each file is compressed ahead of
+time with gzip, and brotli when the brotli module is installed, and the best variant the client
+accepts is sent. Responses of the application above a minimum size are gzipped on the fly.
+"""
+import gzip, hashlib, mimetypes, os, zlib
+from flask import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+# Streamed responses are flushed after their first chunk then every STREAM_FLUSH_SIZE bytes, so that
+# they still arrive as they are produced, a flush per row would cost a third of the compression
+STREAM_FLUSH_SIZE = 4096
+
+COMPRESSIBLE = ("text/", "application/json", "application/x-ndjson", "application/javascript", "image/svg+xml")
+
+
+def accepted_encodings(request):
+    return {x.split(";")[0].strip() for x in request.headers.get("Accept-Encoding", "").split(",")}
+
+
+def compressible(mimetype):
+    return mimetype is not None and mimetype.startswith(COMPRESSIBLE)
+
+
+def hashed_name(filename, digest):
+    root, ext = os.path.splitext(filename)
+    return "{0}.{1}{2}".format(root, digest, ext)
+
+
+class StaticFiles:
+    def __init__(self, directory):
+        self.urls = {}     # file name -> hashed name
+        self.hashed = set()
+        self.files = {}    # hashed or file name -> (mimetype, etag, {encoding: content})
+        for root, _, names in os.walk(directory):
+            for name in names:
+                path = os.path.join(root, name)
+                filename = os.path.relpath(path, directory).replace(os.sep, "/")
+                with open(path, "rb") as f:
+                    content = f.read()
+                self.add(filename, content)
+
+    def add(self, filename, content):
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        variants = {"identity": content}
+        if compressible(mimetype):
+            variants["gzip"] = gzip.compress(content, 9, mtime=0)
+            if brotli is not None:
+                variants["br"] = brotli.compress(content, quality=11)
+            # Tiny files can come out bigger
+            variants = {encoding: x for encoding, x in variants.items()
+                        if encoding == "identity" or len(x) < len(content)}
+
+        digest = hashlib.sha256(content).hexdigest()[:12]
+        name = hashed_name(filename, digest)
+        entry = (mimetype, digest, variants)
+        self.urls[filename] = name
+        self.hashed.add(name)
+        self.files[name] = entry
+        self.files[filename] = entry
+
+    def url(self, filename):
+        """ Name to link filename with, the file name itself if it's unknown """
+        return self.urls.get(filename, filename)
+
+    def response(self, filename, request):
+        """ Response serving filename, None if there's no such file """
+        entry = self.files.get(filename)
+        if entry is None:
+            return None
+        mimetype, tag, variants = entry
+
+        accepted = accepted_encodings(request)
+        encoding = next((x for x in ("br", "gzip") if x in variants and x in accepted), "identity")
+        response = Response(variants[encoding], mimetype=mimetype)
+        if encoding != "identity":
+            response.headers["Content-Encoding"] = encoding
+        if len(variants) > 1:
+            response.vary.add("Accept-Encoding")
+        response.set_etag(tag + ("-" + encoding if encoding != "identity" else ""))
+        # Unhashed names may point to a new version of the file at any time, they must be revalidated
+        response.headers["Cache-Control"] = IMMUTABLE if filename in self.hashed else "public, no-cache"
+        return response.make_conditional(request)
+
+
+def _compress_stream(chunks, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    # The first chunk goes out at once
+    pending = STREAM_FLUSH_SIZE
+    try:
+        for chunk in chunks:
+            chunk = chunk.encode() if isinstance(chunk, str) else chunk
+            data = compressor.compress(chunk)
+            pending += len(chunk)
+            if pending >= STREAM_FLUSH_SIZE:
+                data += compressor.flush(zlib.Z_SYNC_FLUSH)
+                pending = 0
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        # Ends the request context of a stream_with_context() generator when the client goes away
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def compress(response, request, level=6, min_size=1024):
+    """ Gzips response if the client accepts it, its type is text and it's at least min_size bytes,
+    streamed responses of unknown size always are
+    """
+    if level <= 0 or response.status_code != 200 or response.direct_passthrough \
+            or "Content-Encoding" in response.headers or not compressible(response.mimetype):
+        return response
+    response.vary.add("Accept-Encoding")
+    if "gzip" not in accepted_encodings(request):
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, level)
+        response.headers.pop("Content-Length", None)
+    else:
+        body = response.get_data()
+        if len(body) < min_size:
+            return response
+        response.set_data(gzip.compress(body, level, mtime=0))
+
+    response.headers["Content-Encoding"] = "gzip"
+    # The compressed body differs from the one the ETag was computed for, it's only weakly the same
+    tag, weak = response.get_etag()
+    if tag is not None and not weak:
+        response.set_etag(tag, weak=True)
+    return response
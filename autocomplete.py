@@ -0,0 +1,105 @@
+""" In memory prefix index over ingredient names, for autocompletion
+Names are stored normalized (unidecode, lower case) like in the ingredients table.
+Matches are ranked: names starting with the query, then names with a word starting with it,
+then names containing it anywhere, shorter names first in each group.
+Each group is a range of a sorted list: the names, the names from each word on, and the names from each
+of their characters on, a sorted suffix list, so that a query never scans every name.
+"""
+import bisect, heapq, unidecode
+from lazy_index import LazyIndex
+
+
+def normalize(text):
+    return unidecode.unidecode(text).lower().strip()
+
+
+class PrefixIndex(LazyIndex):
+    def __init__(self):
+        super().__init__()
+        self.names = {}     # id -> name
+        self.by_name = []   # sorted (name, id)
+        self.by_word = []   # sorted (word and the rest of the name after it, id), for words after the first
+        self.by_suffix = [] # sorted (suffix of the name, id), for the other suffixes
+
+    @staticmethod
+    def _words(name):
+        # Every position where a word starts, except the beginning which by_name covers
+        return [name[i:] for i in range(1, len(name)) if name[i - 1] in " -'" and name[i] not in " -'"]
+
+    @staticmethod
+    def _suffixes(name):
+        # Every other position, the ones by_name and by_word cover are left out
+        return [name[i:] for i in range(1, len(name)) if name[i - 1] not in " -'" or name[i] in " -'"]
+
+    def _load(self, cur):
+        self.names = {}
+        self.by_name = []
+        self.by_word = []
+        self.by_suffix = []
+        for ingredient_id, name in cur.execute("SELECT id, name FROM ingredients"):
+            self.names[ingredient_id] = name
+            self.by_name.append((name, ingredient_id))
+            self.by_word.extend((word, ingredient_id) for word in self._words(name))
+            self.by_suffix.extend((suffix, ingredient_id) for suffix in self._suffixes(name))
+        self.by_name.sort()
+        self.by_word.sort()
+        self.by_suffix.sort()
+
+    def add(self, ingredient_id, name):
+        with self._lock:
+            if not self._loaded:
+                return
+            self.remove(ingredient_id)
+            self.names[ingredient_id] = name
+            bisect.insort(self.by_name, (name, ingredient_id))
+            for word in self._words(name):
+                bisect.insort(self.by_word, (word, ingredient_id))
+            for suffix in self._suffixes(name):
+                bisect.insort(self.by_suffix, (suffix, ingredient_id))
+
+    def remove(self, ingredient_id):
+        with self._lock:
+            name = self.names.pop(ingredient_id, None)
+            if name is None:
+                return
+            self._discard(self.by_name, (name, ingredient_id))
+            for word in self._words(name):
+                self._discard(self.by_word, (word, ingredient_id))
+            for suffix in self._suffixes(name):
+                self._discard(self.by_suffix, (suffix, ingredient_id))
+
+    @staticmethod
+    def _discard(entries, entry):
+        i = bisect.bisect_left(entries, entry)
+        if i < len(entries) and entries[i] == entry:
+            del entries[i]
+
+    @staticmethod
+    def _prefixed(entries, prefix):
+        i = bisect.bisect_left(entries, (prefix,))
+        while i < len(entries) and entries[i][0].startswith(prefix):
+            yield entries[i][1]
+            i += 1
+
+    def complete(self, query, k=10):
+        """ Returns up to k (id, name) matching query, best first """
+        query = normalize(query)
+        if not query:
+            return []
+
+        with self._lock:
+            groups = (
+                lambda: self._prefixed(self.by_name, query),
+                lambda: self._prefixed(self.by_word, query),
+                # Only reached when fewer than k names have a word starting with the query
+                lambda: self._prefixed(self.by_suffix, query)
+            )
+            ranked = []
+            for group in groups:
+                candidates = set(group()).difference(ranked)
+                best = heapq.nsmallest(k - len(ranked), candidates, key=lambda x: (len(self.names[x]), self.names[x]))
+                ranked.extend(best)
+                if len(ranked) >= k:
+                    break
+
+            return [(x, self.names[x]) for x in ranked]
@@ -0,0 +1 @@
+""" Performance benchmarks of the API on synthetic catalogs, see __main__.py for the usage """
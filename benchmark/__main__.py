@@ -0,0 +1,71 @@
+import argparse, json, os, shutil, sys, tempfile
+from benchmark import generate, run
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmark", description="Benchmarks the API.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate_parser = commands.add_parser("generate", help="Generates a synthetic catalog.")
+    generate_parser.add_argument("db", help="path of the sqlite database to create")
+    run_parser = commands.add_parser("run", help="Runs every scenario and prints the results as JSON.")
+    run_parser.add_argument("--db", help="existing catalog to use, a temporary one is generated otherwise")
+    run_parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    run_parser.add_argument("--warmup", type=int, default=5, help="requests per scenario before measuring")
+    run_parser.add_argument("--scenario", action="append", choices=sorted(run.SCENARIOS),
+                            help="scenarios to run, every one by default")
+    run_parser.add_argument("--cache", action="store_true", help="enable the response cache")
+    run_parser.add_argument("--catalog", action="store_true", help="enable the in memory meal catalog")
+    run_parser.add_argument("--output", help="file to write the results to, stdout by default")
+    for command in (generate_parser, run_parser):
+        command.add_argument("--meals", type=int, default=1000)
+        command.add_argument("--ingredients", type=int, default=10000)
+        command.add_argument("--seed", type=int, default=0)
+
+    compare_parser = commands.add_parser("compare", help="Flags the scenarios that got slower.")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+    compare_parser.add_argument("--threshold", type=float, default=0.1, help="tolerated slowdown, 0.1 is 10%%")
+    compare_parser.add_argument("--metric", default="p95_ms", choices=["mean_ms", "p50_ms", "p95_ms", "p99_ms"])
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        if os.path.exists(args.db):
+            parser.error("{0} already exists.".format(args.db))
+        generate.generate(args.db, args.meals, args.ingredients, args.seed)
+
+    elif args.command == "run":
+        directory = None
+        db_path = args.db
+        if not db_path:
+            directory = tempfile.mkdtemp(prefix="meal-ideas-catalog-")
+            db_path = os.path.join(directory, "catalog.sqlite")
+            generate.generate(db_path, args.meals, args.ingredients, args.seed)
+        try:
+            results = run.run(db_path, args.requests, args.warmup, args.seed, args.scenario, args.cache,
+                              args.catalog)
+        finally:
+            if directory:
+                shutil.rmtree(directory, ignore_errors=True)
+
+        output = json.dumps(results, indent=4)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(output + "\n")
+        else:
+            print(output)
+
+    elif args.command == "compare":
+        with open(args.before) as f:
+            before = json.load(f)
+        with open(args.after) as f:
+            after = json.load(f)
+        regressions = run.compare(before, after, args.threshold, args.metric)
+        for name, old, new, ratio in regressions:
+            print("{0}: {1} {2}ms -> {3}ms (x{4})".format(name, args.metric, old, new, ratio))
+        if regressions:
+            sys.exit(1)
+        print("No regression above {0:.0%}.".format(args.threshold))
+
+
+main()
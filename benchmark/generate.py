@@ -0,0 +1,72 @@
+""" Seeded synthetic catalogs
+Ingredient popularity follows a Zipf like law and the number of ingredients per meal is long tailed,
+so that a few ingredients are in most meals and a few meals have many ingredients, like real recipes.
+"""
+import itertools, random, sqlite3
+import migrations
+
+WORDS = ["tarte", "gratin", "soupe", "salade", "curry", "risotto", "poelee", "veloute", "quiche", "tajine",
+         "pates", "riz", "poulet", "boeuf", "saumon", "legumes", "fromage", "tomate", "courgette", "aubergine",
+         "champignons", "lentilles", "pois", "chiche", "epinards", "potiron", "carottes", "pommes", "poires",
+         "chocolat", "citron", "miel", "moutarde", "basilic", "thym", "provencale", "maison", "rapide",
+         "douce", "epice", "grille", "roti", "mijote", "facon", "grand-mere", "croustillant", "leger"]
+
+SYLLABLES = ["ba", "be", "ca", "co", "da", "fe", "ga", "li", "lo", "ma", "mi", "na", "no", "pa", "po", "ra",
+             "ri", "sa", "so", "ta", "to", "va", "ve", "za"]
+
+
+def ingredient_names(rng, count):
+    names = set()
+    while len(names) < count:
+        name = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4)))
+        if rng.random() < 0.3:
+            name += " " + rng.choice(WORDS)
+        names.add(name)
+    return sorted(names)
+
+
+def meal_ingredient_count(rng):
+    # Mostly 3 to 8 ingredients, sometimes 20 or more
+    return min(40, max(1, int(rng.lognormvariate(1.6, 0.5))))
+
+
+def generate(db_path, meals=1000, ingredients=10000, seed=0, batch_size=5000):
+    """ Fills db_path, which should not exist yet, with a synthetic catalog """
+    rng = random.Random(seed)
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    migrations.migrate(conn)
+    cur = conn.cursor()
+
+    names = ingredient_names(rng, ingredients)
+    cur.execute("BEGIN")
+    cur.executemany("INSERT INTO ingredients (name) VALUES (?)", [[name] for name in names])
+    cur.execute("COMMIT")
+    ingredient_ids = [x[0] for x in cur.execute("SELECT id FROM ingredients ORDER BY id")]
+    # Zipf like popularity: the weight of the nth ingredient is 1/n
+    cum_weights = list(itertools.accumulate(1.0 / (rank + 1) for rank in range(len(ingredient_ids))))
+
+    for start in range(0, meals, batch_size):
+        batch = []
+        for i in range(start, min(meals, start + batch_size)):
+            preparation_time = rng.choice([None, 5, 10, 15, 20, 30, 45, 60])
+            cook_time = rng.choice([None, 0, 10, 20, 30, 45, 60, 90, 120])
+            title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 4))) + " " + str(i)
+            batch.append([title, " ".join(rng.choice(WORDS) for _ in range(rng.randint(0, 12))),
+                          rng.choice([0, 1, 1, 1, 2]), rng.choice([-1, -1, 0, 1]), rng.choice([-1, -1, 0, 1, 2, 3]),
+                          preparation_time, cook_time])
+
+        cur.execute("BEGIN")
+        last_id = cur.execute("SELECT coalesce(max(id), 0) FROM meals").fetchone()[0]
+        cur.executemany("INSERT INTO meals (title, description, meal_entry, meal_time, season, preparation_time, \
+                         cook_time) VALUES (?,?,?,?,?,?,?)", batch)
+        links = []
+        for meal_id in range(last_id + 1, last_id + 1 + len(batch)):
+            chosen = set(rng.choices(ingredient_ids, cum_weights=cum_weights, k=meal_ingredient_count(rng)))
+            links.extend([meal_id, ingredient_id] for ingredient_id in chosen)
+        cur.executemany("INSERT INTO meal_ingredients (meal_id, ingredient_id) VALUES (?,?)", links)
+        cur.execute("COMMIT")
+
+    conn.execute("ANALYZE")
+    conn.close()
@@ -0,0 +1,196 @@
+""" Drives every route of the application through Flask's test client and measures it """
+import json, os, platform, random, shutil, sqlite3, sys, tempfile, time
+
+
+def load_application(db_path, response_cache, meal_catalog=False):
+    """ Imports the application against db_path, through a config module written for it """
+    directory = tempfile.mkdtemp(prefix="meal-ideas-benchmark-")
+    with open(os.path.join(directory, "config.py"), "w") as f:
+        f.write("params = " + repr({
+            "password": "benchmark",
+            "path": "",
+            "db_path": db_path,
+            "secret_key": "benchmark",
+            "response_cache_size": 256 if response_cache else 0,
+            "meal_catalog": meal_catalog
+        }) + "\n")
+    sys.path.insert(0, directory)
+    try:
+        import application
+    finally:
+        sys.path.remove(directory)
+        shutil.rmtree(directory, ignore_errors=True)
+    return application
+
+
+def catalog(db_path):
+    """ What the scenarios need to know to build realistic requests """
+    conn = sqlite3.connect(db_path)
+    context = {
+        "meal_ids": [x[0] for x in conn.execute("SELECT id FROM meals")],
+        # The generator makes low ids the most popular ingredients
+        "ingredient_ids": [x[0] for x in conn.execute("SELECT id FROM ingredients ORDER BY id")],
+        "ingredient_names": [x[0] for x in conn.execute("SELECT name FROM ingredients")],
+        "changes_seq": conn.execute("SELECT coalesce(max(seq), 0) FROM changes").fetchone()[0],
+        "words": sorted({word for (title,) in conn.execute("SELECT title FROM meals LIMIT 1000")
+                         for word in title.split() if not word.isdigit()})
+    }
+    conn.close()
+    return context
+
+
+def popular(rng, context, k=1):
+    return rng.sample(context["ingredient_ids"][:50], k)
+
+
+def _filters(rng):
+    return {
+        "meal_entry": "meal_entry={0}".format(rng.choice([0, 1, 2])),
+        "meal_time": "meal_time={0}".format(rng.choice([-1, 0, 1])),
+        "season": "season={0}".format(rng.choice([-1, 0, 1, 2, 3])),
+        "preparation_time_max": "preparation_time_max={0}".format(rng.choice([10, 20, 30])),
+        "cook_time_max": "cook_time_max={0}".format(rng.choice([10, 30, 60])),
+        "total_time_max": "total_time_max={0}".format(rng.choice([20, 45, 90]))
+    }
+
+
+def search(*names):
+    def build(rng, context):
+        filters = _filters(rng)
+        args = [filters[name] for name in names if name in filters]
+        if "title" in names:
+            args.append("title=" + rng.choice(context["words"])[:5])
+        if "ingredients" in names:
+            args.append("ingredients=" + json.dumps(popular(rng, context, 2)))
+        return "GET", "/api/meals?" + "&".join(args), None
+    return build
+
+
+SCENARIOS = {
+    "search_all": search(),
+    "search_title": search("title"),
+    "search_meal_entry": search("meal_entry"),
+    "search_meal_time": search("meal_time"),
+    "search_season": search("season"),
+    "search_preparation_time": search("preparation_time_max"),
+    "search_cook_time": search("cook_time_max"),
+    "search_total_time": search("total_time_max"),
+    "search_ingredients": search("ingredients"),
+    "search_combined": search("meal_entry", "meal_time", "season", "total_time_max", "ingredients"),
+    "search_title_combined": search("title", "season", "total_time_max"),
+    "search_ingredients_any": lambda rng, c: ("GET", "/api/meals?ingredients_any="
+                                              + json.dumps(popular(rng, c, 3)) + "&limit=50", None),
+    "search_page": lambda rng, c: ("GET", "/api/meals?limit=50&after=" + str(rng.choice(c["meal_ids"])), None),
+    "random": lambda rng, c: ("GET", "/api/meals?mode=random&" + _filters(rng)["season"], None),
+    "random_count": lambda rng, c: ("GET", "/api/meals?mode=random&count=10", None),
+    "random_weighted": lambda rng, c: ("GET", "/api/meals?mode=random&count=5&weight=fresh", None),
+    "pantry": lambda rng, c: ("GET", "/api/meals?mode=pantry&ingredients="
+                              + json.dumps(popular(rng, c, 8)), None),
+    "meal": lambda rng, c: ("GET", "/api/meals/" + str(rng.choice(c["meal_ids"])), None),
+    "meal_expanded": lambda rng, c: ("GET", "/api/meals/" + str(rng.choice(c["meal_ids"])) + "?expand=ingredients",
+                                     None),
+    "ingredients_search": lambda rng, c: ("GET", "/api/ingredients?q=" + rng.choice(c["ingredient_names"])[:3], None),
+    "ingredients_autocomplete": lambda rng, c: ("GET", "/api/ingredients?mode=autocomplete&q="
+                                                + rng.choice(c["ingredient_names"])[:3], None),
+    "ingredients_many": lambda rng, c: ("GET", "/api/ingredients?mode=many&q="
+                                        + json.dumps(rng.sample(c["ingredient_ids"], 10)), None),
+    "similar": lambda rng, c: ("GET", "/api/meals/" + str(rng.choice(c["meal_ids"])) + "/similar", None),
+    "similar_exact": lambda rng, c: ("GET", "/api/meals/" + str(rng.choice(c["meal_ids"])) + "/similar?mode=exact",
+                                     None),
+    "plan": lambda rng, c: ("GET", "/api/plan?days={0}&season=-1".format(rng.choice([3, 7, 14])), None),
+    # Read only, so that the catalog stays the same
+    "batch": lambda rng, c: ("POST", "/api/batch", [{"path": "/api/meals/" + str(x)}
+                                                    for x in rng.sample(c["meal_ids"], 4)]
+                             + [{"path": "/api/meals?limit=20&" + _filters(rng)["season"]}]),
+    "changes": lambda rng, c: ("GET", "/api/changes?since=" + str(rng.randint(0, c["changes_seq"])), None),
+    "ingredient": lambda rng, c: ("GET", "/api/ingredients/" + str(rng.choice(c["ingredient_ids"])), None),
+    "meal_post": lambda rng, c: ("POST", "/api/meals", {
+        "title": "benchmark {0}".format(rng.random()),
+        "season": str(rng.choice([-1, 0, 1, 2, 3])),
+        "cook_time": str(rng.choice([10, 20, 30])),
+        "ingredients": json.dumps(popular(rng, c, 5))
+    })
+}
+
+
+def percentile(values, fraction):
+    """ Nearest rank percentile of sorted values """
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+
+def measure(client, requests):
+    """ Runs the (method, url, data) requests, returns the summary of their latencies """
+    latencies = []
+    errors = 0
+    responses = []
+    start = time.perf_counter()
+    for method, url, data in requests:
+        before = time.perf_counter()
+        # Lists are sent as a JSON body, dicts as a form
+        response = client.open(url, method=method, **({"json": data} if isinstance(data, list) else {"data": data}))
+        latencies.append(time.perf_counter() - before)
+        if response.status_code != 200:
+            errors += 1
+        responses.append(response)
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": round(len(latencies) / elapsed, 1),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 3),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3)
+    }, responses
+
+
+def run(db_path, requests=200, warmup=5, seed=0, scenarios=None, response_cache=False, meal_catalog=False):
+    application = load_application(db_path, response_cache, meal_catalog)
+    context = catalog(db_path)
+    client = application.app.test_client()
+    client.post("/login", data={"password": "benchmark"})
+
+    results = {}
+    created = []
+    for name in scenarios or SCENARIOS:
+        rng = random.Random("{0}-{1}".format(seed, name))
+        build = SCENARIOS[name]
+        if name != "meal_post":
+            measure(client, [build(rng, context) for _ in range(warmup)])
+        results[name], responses = measure(client, [build(rng, context) for _ in range(requests)])
+        if name == "meal_post":
+            created = [r.get_json()["data"]["meal_id"] for r in responses if r.status_code == 200]
+
+    # Deleting what meal_post created keeps the catalog the same from one run to the next
+    if created:
+        results["meal_delete"], _ = measure(client, [("DELETE", "/api/meals/" + str(x), None) for x in created])
+
+    return {
+        "meta": {
+            "meals": len(context["meal_ids"]),
+            "ingredients": len(context["ingredient_ids"]),
+            "requests": requests,
+            "seed": seed,
+            "response_cache": response_cache,
+            "meal_catalog": meal_catalog,
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "machine": platform.machine(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S")
+        },
+        "results": results
+    }
+
+
+def compare(before, after, threshold=0.1, metric="p95_ms"):
+    """ Returns [(scenario, before, after, ratio)] of the scenarios slower by more than threshold """
+    regressions = []
+    for name, result in after["results"].items():
+        if name not in before["results"]:
+            continue
+        old, new = before["results"][name][metric], result[metric]
+        if old > 0 and (new - old) / old > threshold:
+            regressions.append((name, old, new, round(new / old, 2)))
+    return regressions
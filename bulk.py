@@ -0,0 +1,169 @@
+""" Bulk import and export of meals with their ingredients
+Meals are exchanged as objects like the ones of /api/meals, except that ingredients are names:
+    {"title": ..., "description": ..., "meal_entry": 1, "meal_time": -1, "season": -1,
+     "preparation_time": 10, "cook_time": 20, "ingredients": ["tomate", "oignon"]}
+as a JSON array (like meals.json) or as NDJSON, one meal per line. NDJSON is read as a stream,
+a JSON array is parsed at once. Imports run in batches, each batch is a single transaction.
+"""
+import json, unidecode
+
+BATCH_SIZE = 500
+
+
+def read_json(stream):
+    meals = json.load(stream)
+    if not isinstance(meals, list):
+        raise ValueError("Expected a JSON array of meals.")
+    return iter(meals)
+
+
+def read_ndjson(stream):
+    """ Malformed lines, invalid UTF-8 included, are yielded as None, they end up in the errors of the import report """
+    for line in stream:
+        try:
+            if isinstance(line, bytes):
+                line = line.decode("utf-8")
+            if line.strip():
+                yield json.loads(line)
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            yield None
+
+
+def _int(meal, key, default, allowed=None):
+    value = meal.get(key)
+    if value is None or value == "":
+        return default
+    value = int(value)
+    if allowed is not None and not value in allowed:
+        raise ValueError("Invalid {0}: {1}".format(key, value))
+    if allowed is None and value < 0:
+        raise ValueError("Invalid {0}, should be a positive number".format(key))
+    return value
+
+
+def normalize(meal):
+    """ Validates a meal the same way POST /api/meals does, raises ValueError if it's invalid """
+    if not isinstance(meal, dict):
+        raise ValueError("Malformed meal")
+    if not meal.get("title"):
+        raise ValueError("Missing title")
+
+    ingredients = meal.get("ingredients") or []
+    if not isinstance(ingredients, list) or not all(isinstance(x, str) and x.strip() for x in ingredients):
+        raise ValueError("Ingredients should be an array of names")
+
+    return {
+        "title": unidecode.unidecode(str(meal["title"])),
+        "description": unidecode.unidecode(str(meal.get("description") or "")),
+        "meal_entry": _int(meal, "meal_entry", 1, {0, 1, 2}),
+        "meal_time": _int(meal, "meal_time", -1, {-1, 0, 1}),
+        "season": _int(meal, "season", -1, {-1, 0, 1, 2, 3}),
+        "preparation_time": _int(meal, "preparation_time", None),
+        "cook_time": _int(meal, "cook_time", None),
+        # Same normalization as POST /api/ingredients, duplicates removed
+        "ingredients": list(dict.fromkeys(unidecode.unidecode(x).lower() for x in ingredients))
+    }
+
+
+def _import_batch(cur, batch):
+    """ Inserts a batch of normalized meals, returns the number of meals inserted """
+    # Resolve ingredients by name, creating the missing ones
+    names = sorted({name for meal in batch for name in meal["ingredients"]})
+    cur.executemany("INSERT INTO ingredients (name) VALUES (?) ON CONFLICT (name) DO NOTHING",
+                    [[name] for name in names])
+    ingredient_ids = dict(cur.execute("SELECT name, id FROM ingredients WHERE name IN (SELECT value FROM json_each(?))",
+                                      [json.dumps(names)]))
+
+    # Meals whose title already exists are skipped, ids being AUTOINCREMENT the new ones are above last_id
+    last_id = cur.execute("SELECT coalesce(max(id), 0) FROM meals").fetchone()[0]
+    cur.executemany("INSERT INTO meals (title, description, meal_entry, meal_time, season, preparation_time, cook_time) \
+                     VALUES (?,?,?,?,?,?,?) ON CONFLICT (title) DO NOTHING",
+                    [[meal["title"], meal["description"], meal["meal_entry"], meal["meal_time"], meal["season"],
+                      meal["preparation_time"], meal["cook_time"]] for meal in batch])
+    inserted = cur.rowcount
+
+    meal_ids = dict(cur.execute("SELECT title, id FROM meals WHERE id > ?", [last_id]))
+    cur.executemany("INSERT INTO meal_ingredients (meal_id, ingredient_id) VALUES (?,?) \
+                     ON CONFLICT (meal_id, ingredient_id) DO NOTHING",
+                    [[meal_ids[meal["title"]], ingredient_ids[name]]
+                     for meal in batch if meal["title"] in meal_ids for name in meal["ingredients"]])
+    return inserted
+
+
+def import_meals(write, meals, batch_size=BATCH_SIZE, progress=None):
+    """ Imports an iterable of meal objects, write(function) runs function(cursor) in a write transaction
+    and returns its result, it is called once per batch. Returns a report:
+        read     -> number of meals read
+        imported -> number of meals inserted
+        skipped  -> meals whose title already existed
+        errors   -> [index, message] of the invalid meals, they are not imported
+    progress is called with the report after each batch
+    """
+    report = {"read": 0, "imported": 0, "skipped": 0, "errors": []}
+
+    def flush(batch):
+        inserted = write(lambda cur: _import_batch(cur, batch))
+        report["imported"] += inserted
+        report["skipped"] += len(batch) - inserted
+        if progress:
+            progress(report)
+
+    batch = []
+    seen = set()
+    for index, meal in enumerate(meals):
+        report["read"] += 1
+        try:
+            meal = normalize(meal)
+        except (TypeError, ValueError) as e:
+            report["errors"].append([index, str(e)])
+            continue
+
+        # A title appearing twice in the input would be inserted once and linked twice
+        if meal["title"] in seen:
+            report["skipped"] += 1
+            continue
+        seen.add(meal["title"])
+
+        batch.append(meal)
+        if len(batch) >= batch_size:
+            flush(batch)
+            batch = []
+    if batch:
+        flush(batch)
+
+    return report
+
+
+def export_meals(cur):
+    """ Yields every meal with its ingredient names, rows are read from cur as they are yielded """
+    query = "SELECT title, description, meal_entry, meal_time, season, preparation_time, cook_time, \
+             json_group_array(ingredients.name) FILTER (WHERE ingredients.id IS NOT NULL) FROM meals \
+             LEFT JOIN meal_ingredients ON meal_ingredients.meal_id = meals.id \
+             LEFT JOIN ingredients ON ingredients.id = meal_ingredients.ingredient_id \
+             GROUP BY meals.id ORDER BY meals.id"
+    for meal in cur.execute(query):
+        yield {
+            "title": meal[0],
+            "description": meal[1],
+            "meal_entry": meal[2],
+            "meal_time": meal[3],
+            "season": meal[4],
+            "preparation_time": meal[5],
+            "cook_time": meal[6],
+            "ingredients": json.loads(meal[7])
+        }
+
+
+def write_json(meals):
+    """ Encodes meals as a JSON array, one chunk per meal """
+    first = True
+    yield "["
+    for meal in meals:
+        yield ("\n    " if first else ",\n    ") + json.dumps(meal)
+        first = False
+    yield "\n]\n"
+
+
+def write_ndjson(meals):
+    for meal in meals:
+        yield json.dumps(meal) + "\n"
@@ -0,0 +1,90 @@
+""" Response cache for the read endpoints
+Entries are keyed on the path and the normalized query string, and are only valid for the
+data generation they were computed at: every successful write bumps the generation, which
+empties the cache. Eviction is least recently used, bounded by the number of entries.
+"""
+import collections, hashlib, threading
+
+
+def etag(body):
+    return hashlib.sha1(body).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.generation = 0
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()   # key -> (etag, body, mimetype)
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0
+        }
+
+    @staticmethod
+    def key(path, args):
+        # Same parameters in any order share an entry
+        return path, tuple(sorted(args.items(multi=True)))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+            return entry
+
+    def put(self, key, generation, entry):
+        with self._lock:
+            # The data changed while this response was computed, it may already be stale
+            if generation != self.generation or self.max_entries <= 0:
+                return
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def bump(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["generation"] = self.generation
+        return stats
+
+
+class GenerationTracker:
+    """ Follows the data_generation row, which triggers bump on every write to the data,
+    so that a process notices the writes made by other processes or by hand.
+    Writes made by this process are reported with own_write() so that they don't
+    cause a full invalidation of state that was already updated in place.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.seen = None
+
+    @staticmethod
+    def read(cur):
+        return cur.execute("SELECT value FROM data_generation WHERE id = 0").fetchone()[0]
+
+    def check(self, cur):
+        """ Returns True if someone else wrote since the last check """
+        value = self.read(cur)
+        with self._lock:
+            changed = self.seen is not None and value != self.seen
+            self.seen = value
+        return changed
+
+    def own_write(self, before, after):
+        with self._lock:
+            # If someone else wrote before us, leave it to check() to notice it
+            if before == self.seen:
+                self.seen = after
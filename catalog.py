@@ -0,0 +1,220 @@
+""" In memory columnar catalog of the meal attributes the search filters work on
+Attributes are kept in typed arrays indexed by row, rows being in increasing meal id order,
+and every value of a column has a bitmap of the rows holding it, stored as a Python int.
+A filter is then a few bitwise operations on those bitmaps, a machine word handles 64 meals at once,
+instead of sqlite evaluating the conditions row by row.
+SQL_FILTERS are the same filters for sqlite, used when the catalog is disabled.
+"""
+import array, bisect, itertools, random
+from lazy_index import LazyIndex
+
+# Stands for NULL in the typed arrays, -1 being a valid meal_time and season
+NULL = -2 ** 31
+
+# Search filter -> SQL condition, the catalog gives the same results
+SQL_FILTERS = {
+    "meal_entry": " meal_entry = ? ",
+    "meal_time": " meal_time = ? ",
+    "season": " season = ? ",
+    "preparation_time_max": " preparation_time <= ? ",
+    "cook_time_max": " cook_time <= ? ",
+    "total_time_max": " total_time <= ? "
+}
+
+# Search filter -> column it applies to
+_FILTER_COLUMNS = {
+    "meal_entry": "meal_entry",
+    "meal_time": "meal_time",
+    "season": "season",
+    "preparation_time_max": "preparation_time",
+    "cook_time_max": "cook_time",
+    "total_time_max": "total_time"
+}
+
+COLUMNS = ("meal_entry", "meal_time", "season", "preparation_time", "cook_time")
+
+# Column -> array typecode, total_time is computed like the generated column of meals
+_TYPECODES = {"meal_entry": "b", "meal_time": "b", "season": "b", "preparation_time": "q", "cook_time": "q",
+              "total_time": "q"}
+
+# bin() digits to the 0 and 1 bytes itertools.compress() selects with
+_DIGITS = bytes.maketrans(b"01", b"\x00\x01")
+
+
+def _bitmap(rows):
+    flags = bytearray((max(rows) >> 3) + 1)
+    for row in rows:
+        flags[row >> 3] |= 1 << (row & 7)
+    return int.from_bytes(flags, "little")
+
+
+class MealCatalog(LazyIndex):
+    def __init__(self):
+        super().__init__()
+        self._clear()
+
+    def _clear(self):
+        self.ids = array.array("q")                    # row -> meal id, increasing
+        self.columns = {column: array.array(typecode) for column, typecode in _TYPECODES.items()}
+        self.bitmaps = {column: {} for column in self.columns}     # column -> value -> bitmap of rows
+        self.alive = 0                                 # bitmap of the rows of meals not deleted
+        self.dead = 0
+
+    @staticmethod
+    def _values(meal):
+        values = [NULL if meal.get(column) is None else meal[column] for column in COLUMNS]
+        values.append(NULL if NULL in values[3:5] else values[3] + values[4])
+        return values
+
+    def _load(self, cur):
+        self._clear()
+        rows = {column: {} for column in self.columns}
+        for row, meal in enumerate(cur.execute("SELECT id, meal_entry, meal_time, season, preparation_time, \
+                                                cook_time FROM meals ORDER BY id")):
+            self.ids.append(meal[0])
+            values = self._values(dict(zip(COLUMNS, meal[1:])))
+            for column, value in zip(self.columns, values):
+                self.columns[column].append(value)
+                if value != NULL:
+                    rows[column].setdefault(value, []).append(row)
+
+        for column in self.columns:
+            self.bitmaps[column] = {value: _bitmap(x) for value, x in rows[column].items()}
+        self.alive = (1 << len(self.ids)) - 1
+
+    def _row(self, meal_id):
+        row = bisect.bisect_left(self.ids, meal_id)
+        if row < len(self.ids) and self.ids[row] == meal_id and self.alive >> row & 1:
+            return row
+        return None
+
+    def _set(self, row, values):
+        bit = 1 << row
+        for column, value in zip(self.columns, values):
+            self.columns[column][row] = value
+            if value != NULL:
+                bitmaps = self.bitmaps[column]
+                bitmaps[value] = bitmaps.get(value, 0) | bit
+
+    def _unset(self, row):
+        mask = ~(1 << row)
+        for column in self.columns:
+            value = self.columns[column][row]
+            if value != NULL:
+                bitmaps = self.bitmaps[column]
+                bitmap = bitmaps[value] & mask
+                if bitmap:
+                    bitmaps[value] = bitmap
+                else:
+                    del bitmaps[value]
+
+    def add(self, meal_id, meal):
+        """ meal has the values of COLUMNS, missing ones are NULL """
+        with self._lock:
+            if not self._loaded:
+                return
+            if self.ids and meal_id <= self.ids[-1]:
+                # Rows must stay in id order, only happens if ids were reused
+                self._loaded = False
+                return
+            row = len(self.ids)
+            self.ids.append(meal_id)
+            for column in self.columns.values():
+                column.append(0)
+            self._set(row, self._values(meal))
+            self.alive |= 1 << row
+
+    def update(self, meal_id, changes):
+        """ changes has some of COLUMNS, the others keep their value """
+        with self._lock:
+            if not self._loaded:
+                return
+            row = self._row(meal_id)
+            if row is None:
+                return
+            meal = {column: self.columns[column][row] for column in COLUMNS}
+            meal = {column: None if value == NULL else value for column, value in meal.items()}
+            meal.update((column, changes[column]) for column in COLUMNS if column in changes)
+            self._unset(row)
+            self._set(row, self._values(meal))
+
+    def remove(self, meal_id):
+        with self._lock:
+            if not self._loaded:
+                return
+            row = self._row(meal_id)
+            if row is None:
+                return
+            self._unset(row)
+            self.alive &= ~(1 << row)
+            self.dead += 1
+            # Deleted rows are only dropped by a reload, done once they outnumber the live ones
+            if self.dead > len(self.ids) // 2:
+                self._loaded = False
+
+    def _check(self, row, filters):
+        for name, value in filters.items():
+            x = self.columns[_FILTER_COLUMNS[name]][row]
+            if x == NULL or (x > value if name.endswith("_max") else x != value):
+                return False
+        return True
+
+    def filter(self, filters, candidates=None):
+        """ Returns the ids, in increasing order, of the meals matching every filter,
+        filters being a {name: value} dict with the names of SQL_FILTERS.
+        Only the meals of candidates, a set of ids, are returned if it is given.
+        """
+        with self._lock:
+            if candidates is not None and len(candidates) * 64 < len(self.ids):
+                # Fewer candidates than words in a bitmap, checking them one by one is cheaper
+                rows = (self._row(meal_id) for meal_id in sorted(candidates))
+                return [self.ids[row] for row in rows if row is not None and self._check(row, filters)]
+
+            mask = self.alive
+            for name, value in filters.items():
+                bitmaps = self.bitmaps[_FILTER_COLUMNS[name]]
+                if name.endswith("_max"):
+                    matched = 0
+                    for x, bitmap in bitmaps.items():
+                        if x <= value:
+                            matched |= bitmap
+                else:
+                    matched = bitmaps.get(value, 0)
+                mask &= matched
+                if not mask:
+                    return []
+            matched = itertools.compress(self.ids, bin(mask)[:1:-1].encode("ascii").translate(_DIGITS))
+            if candidates is not None:
+                return [meal_id for meal_id in matched if meal_id in candidates]
+            return list(matched)
+
+
+def sql_filter(cur, filters):
+    """ Same as MealCatalog.filter(), evaluated by sqlite """
+    query = "SELECT id FROM meals"
+    if filters:
+        query += " WHERE " + " AND ".join(SQL_FILTERS[name] for name in filters)
+    return [x[0] for x in cur.execute(query + " ORDER BY id", list(filters.values()))]
+
+
+def random_filters(rng, catalog):
+    """ A random combination of filters, with values taken from the catalog so that they match something """
+    filters = {}
+    for name in rng.sample(list(SQL_FILTERS), rng.randint(0, len(SQL_FILTERS))):
+        values = list(catalog.bitmaps[_FILTER_COLUMNS[name]]) or [0]
+        filters[name] = rng.choice(values) + (rng.choice([-1, 0, 1]) if name.endswith("_max") else 0)
+    return filters
+
+
+def check(cur, catalog, samples=100, seed=None):
+    """ Compares the catalog to sqlite on random filters, returns the [(filters, catalog ids, sql ids)] that differ """
+    rng = random.Random(seed)
+    catalog.ensure_loaded(cur)
+    mismatches = []
+    for _ in range(samples):
+        filters = random_filters(rng, catalog)
+        expected = sql_filter(cur, filters)
+        found = catalog.filter(filters)
+        if found != expected:
+            mismatches.append((filters, found, expected))
+    return mismatches
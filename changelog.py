@@ -0,0 +1,54 @@
+""" Change feed of meals and ingredients
+Triggers write every insert, update and delete of a meal or an ingredient to the changes table,
+seq increasing with every change. A client keeps the seq of the last change it applied and asks
+for the changes since then, it refetches the meals and ingredients inserted or updated and drops
+the deleted ones. Compaction keeps only the last change of each entity and the KEEP latest changes,
+a client whose seq is older than what was dropped must resync, fetching everything again.
+"""
+import database
+
+KEEP = 10000
+
+# Compaction runs when the data generation goes past a multiple of this
+COMPACT_EVERY = 1000
+
+
+def latest(cur):
+    return cur.execute("SELECT coalesce(max(seq), 0) FROM changes").fetchone()[0]
+
+
+def since(cur, seq, limit):
+    """ Returns (changes, seq, more, resync):
+        changes -> [{seq, entity, id, op}] after seq, oldest first, at most limit
+        seq     -> seq of the last change returned, to ask for the next ones
+        more    -> whether there are more changes after these
+        resync  -> the changes after seq are no longer all known, the client must fetch everything again,
+                   then follow the changes from the returned seq
+    """
+    compacted = cur.execute("SELECT seq FROM changes_compacted WHERE id = 0").fetchone()[0]
+    last = latest(cur)
+    if seq < compacted or seq > last:
+        return [], last, False, True
+
+    rows = cur.execute("SELECT seq, entity, entity_id, op FROM changes WHERE seq > ? ORDER BY seq LIMIT ?",
+                       [seq, limit + 1]).fetchall()
+    more = len(rows) > limit
+    changes = [{"seq": x[0], "entity": x[1], "id": x[2], "op": x[3]} for x in rows[:limit]]
+    return changes, changes[-1]["seq"] if changes else seq, more, False
+
+
+def compact(cur, keep=KEEP):
+    """ Drops the changes superseded by a later change of the same entity, then all but the keep latest.
+    Returns the number of changes dropped.
+    """
+    with database.transaction(cur):
+        cur.execute("""DELETE FROM changes WHERE seq < (
+                           SELECT max(seq) FROM changes AS later
+                           WHERE later.entity = changes.entity AND later.entity_id = changes.entity_id)""")
+        dropped = cur.rowcount
+        horizon = latest(cur) - keep
+        cur.execute("DELETE FROM changes WHERE seq <= ?", [horizon])
+        if cur.rowcount:
+            dropped += cur.rowcount
+            cur.execute("UPDATE changes_compacted SET seq = max(seq, ?) WHERE id = 0", [horizon])
+    return dropped
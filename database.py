@@ -0,0 +1,161 @@
+import atexit, contextlib, os, re, sqlite3, threading
+
+# Applied to every new connection, can be overridden with params["db_pragmas"]
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",     # readers don't block the writer and vice versa
+    "synchronous": "NORMAL",   # safe with WAL, one fsync per checkpoint instead of per commit
+    "cache_size": -8000,       # negative means KiB, so ~8MB of page cache per connection
+    "mmap_size": 67108864,     # 64MB of memory mapped I/O
+    "busy_timeout": 5000,      # wait up to 5s on a locked database instead of failing
+    "temp_store": "MEMORY"
+}
+
+_pragma_name = re.compile(r"^[a-z_]+$")
+
+
+class ConnectionPool:
+    """ Keeps long lived sqlite connections around so that requests don't pay for
+    opening the database, parsing the schema and setting pragmas every time.
+    Connections are handed out with acquire() and given back with release(), idle
+    connections are kept up to max_idle, the rest are closed.
+    Each connection keeps its own cache of prepared statements (cached_statements).
+    The pool is reset after a fork, a child process never reuses the parent's connections.
+    """
+    def __init__(self, db_path, pragmas=None, max_idle=4, cached_statements=128):
+        self.db_path = db_path
+        self.pragmas = dict(DEFAULT_PRAGMAS)
+        if pragmas:
+            self.pragmas.update(pragmas)
+        for name in self.pragmas:
+            if not _pragma_name.match(name):
+                raise ValueError("Invalid pragma name: {0}".format(name))
+
+        self.max_idle = max_idle
+        self.cached_statements = cached_statements
+
+        self._lock = threading.Lock()
+        self._idle = []
+        self._pid = os.getpid()
+        self._stats = {
+            "created": 0,
+            "reused": 0,
+            "released": 0,
+            "closed": 0,
+            "in_use": 0
+        }
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False,
+                               cached_statements=self.cached_statements)
+        for name, value in self.pragmas.items():
+            if value is None:
+                continue
+            conn.execute("PRAGMA {0}={1}".format(name, value))
+        return conn
+
+    def _check_fork(self):
+        # Connections must never cross a fork, drop whatever the parent had
+        if os.getpid() != self._pid:
+            self._idle = []
+            self._pid = os.getpid()
+            for key in self._stats:
+                self._stats[key] = 0
+
+    def acquire(self):
+        with self._lock:
+            self._check_fork()
+            self._stats["in_use"] += 1
+            if self._idle:
+                self._stats["reused"] += 1
+                return self._idle.pop()
+            self._stats["created"] += 1
+
+        try:
+            return self._connect()
+        except Exception:
+            with self._lock:
+                self._stats["in_use"] -= 1
+                self._stats["created"] -= 1
+            raise
+
+    def release(self, conn):
+        if os.getpid() != self._pid:
+            # Acquired before a fork, it belongs to the parent process
+            return
+
+        if conn.in_transaction:
+            conn.rollback()
+
+        with self._lock:
+            self._stats["in_use"] = max(0, self._stats["in_use"] - 1)
+            self._stats["released"] += 1
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+            self._stats["closed"] += 1
+        conn.close()
+
+    @contextlib.contextmanager
+    def connection(self):
+        """ Borrows a connection outside of a request """
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close(self):
+        """ Closes every idle connection, used on shutdown """
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._stats["closed"] += len(idle)
+        for conn in idle:
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["idle"] = len(self._idle)
+            stats["max_idle"] = self.max_idle
+        return stats
+
+
+@contextlib.contextmanager
+def transaction(cur):
+    """ Runs the statements of the block in a single write transaction, rolled back on error.
+    The write lock is taken at BEGIN so that reads in the block see the state the writes apply to.
+    Inside a transaction that is already open, the block is a savepoint of it instead.
+    """
+    if cur.connection.in_transaction:
+        cur.execute("SAVEPOINT block")
+        try:
+            yield cur
+        except BaseException:
+            cur.execute("ROLLBACK TO block")
+            cur.execute("RELEASE block")
+            raise
+        cur.execute("RELEASE block")
+        return
+
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        yield cur
+    except BaseException:
+        cur.execute("ROLLBACK")
+        raise
+    try:
+        cur.execute("COMMIT")
+    except BaseException:
+        # A failed COMMIT (busy, disk full, I/O error) can leave the transaction open, and the write lock held
+        if cur.connection.in_transaction:
+            cur.execute("ROLLBACK")
+        raise
+
+
+def create_pool(params):
+    pool = ConnectionPool(params["db_path"],
+                          pragmas=params.get("db_pragmas"),
+                          max_idle=params.get("db_pool_size", 4),
+                          cached_statements=params.get("db_cached_statements", 128))
+    atexit.register(pool.close)
+    return pool
@@ -0,0 +1,80 @@
+""" Full text search over meal titles and descriptions with SQLite FTS5
+meals_fts is an external content table over meals, kept in sync by triggers,
+so every write path, including direct SQL, updates it.
+"""
+import sqlite3, unidecode
+
+SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS meals_fts USING fts5(
+           title, description, content='meals', content_rowid='id',
+           tokenize='unicode61 remove_diacritics 2', prefix='2 3')""",
+    """CREATE TRIGGER IF NOT EXISTS meals_fts_insert AFTER INSERT ON meals BEGIN
+           INSERT INTO meals_fts (rowid, title, description) VALUES (new.id, new.title, new.description);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS meals_fts_delete AFTER DELETE ON meals BEGIN
+           INSERT INTO meals_fts (meals_fts, rowid, title, description)
+           VALUES ('delete', old.id, old.title, old.description);
+       END""",
+    """CREATE TRIGGER IF NOT EXISTS meals_fts_update AFTER UPDATE OF title, description ON meals BEGIN
+           INSERT INTO meals_fts (meals_fts, rowid, title, description)
+           VALUES ('delete', old.id, old.title, old.description);
+           INSERT INTO meals_fts (rowid, title, description) VALUES (new.id, new.title, new.description);
+       END"""
+]
+
+
+def available(conn):
+    return conn.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')").fetchone()[0] == 1 or _probe(conn)
+
+
+def _probe(conn):
+    try:
+        conn.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)")
+        conn.execute("DROP TABLE temp.fts5_probe")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def setup(conn):
+    """ Creates the index and its triggers if needed, returns False if FTS5 isn't available """
+    if not available(conn):
+        return False
+
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        is_new = not cur.execute("SELECT 1 FROM sqlite_master WHERE name='meals_fts'").fetchone()
+        for statement in SCHEMA:
+            cur.execute(statement)
+        if is_new:
+            cur.execute("INSERT INTO meals_fts (meals_fts) VALUES ('rebuild')")
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+    return True
+
+
+def rebuild(conn):
+    """ Rebuilds the index from the meals table, and merges its segments """
+    conn.execute("INSERT INTO meals_fts (meals_fts) VALUES ('rebuild')")
+    conn.execute("INSERT INTO meals_fts (meals_fts) VALUES ('optimize')")
+
+
+def match_expression(text):
+    """ Every word of text must appear, as a word or a word prefix,
+    accents are removed the same way they are when meals are added
+    """
+    tokens = unidecode.unidecode(text).split()
+    return " ".join('"' + token.replace('"', '""') + '"*' for token in tokens)
+
+
+def search(cur, text):
+    """ Returns the ids of the meals matching text, best match (bm25) first """
+    expression = match_expression(text)
+    if not expression:
+        return []
+    # Title matches weigh more than description matches
+    return [x[0] for x in cur.execute("SELECT rowid FROM meals_fts WHERE meals_fts MATCH ? \
+                                       ORDER BY bm25(meals_fts, 10.0, 1.0)", [expression])]
@@ -0,0 +1,113 @@
+""" In memory inverted index from ingredients to meals
+Answers ingredient filters by set operations instead of one correlated subquery per ingredient,
+and ranks meals by how much of them can be cooked with a given pantry.
+"""
+import collections, heapq
+from lazy_index import LazyIndex
+
+
+class IngredientIndex(LazyIndex):
+    def __init__(self):
+        super().__init__()
+        self.postings = {}     # ingredient id -> set of meal ids
+        self.meals = {}        # meal id -> set of ingredient ids
+
+    def _load(self, cur):
+        postings = collections.defaultdict(set)
+        meals = collections.defaultdict(set)
+        for meal_id, ingredient_id in cur.execute("SELECT meal_id, ingredient_id FROM meal_ingredients"):
+            postings[ingredient_id].add(meal_id)
+            meals[meal_id].add(ingredient_id)
+
+        self.postings = dict(postings)
+        self.meals = dict(meals)
+
+    def add_meal(self, meal_id, ingredient_ids):
+        with self._lock:
+            if not self._loaded:
+                return
+            self.remove_meal(meal_id)
+            if not ingredient_ids:
+                return
+            self.meals[meal_id] = set(ingredient_ids)
+            for ingredient_id in ingredient_ids:
+                self.postings.setdefault(ingredient_id, set()).add(meal_id)
+
+    def remove_meal(self, meal_id):
+        with self._lock:
+            for ingredient_id in self.meals.pop(meal_id, ()):
+                posting = self.postings.get(ingredient_id)
+                if posting is not None:
+                    posting.discard(meal_id)
+                    if not posting:
+                        del self.postings[ingredient_id]
+
+    def remove_ingredient(self, ingredient_id):
+        """ Returns the ids of the meals that had the ingredient, None if the index isn't loaded """
+        with self._lock:
+            if not self._loaded:
+                return None
+            meal_ids = self.postings.pop(ingredient_id, set())
+            for meal_id in meal_ids:
+                ingredients = self.meals.get(meal_id)
+                if ingredients is not None:
+                    ingredients.discard(ingredient_id)
+                    if not ingredients:
+                        del self.meals[meal_id]
+            return meal_ids
+
+    def match(self, all_of=(), any_of=(), none_of=()):
+        """ Returns the set of meal ids containing every ingredient of all_of, at least one of any_of
+        and none of none_of. Returns None when only none_of is given, since the result
+        is then "every meal but these", which is better expressed as an exclusion.
+        """
+        with self._lock:
+            result = None
+            # Smallest posting list first keeps the intersections small
+            for ingredient_id in sorted(set(all_of), key=lambda x: len(self.postings.get(x, ()))):
+                posting = self.postings.get(ingredient_id, set())
+                result = set(posting) if result is None else result & posting
+                if not result:
+                    return set()
+
+            if any_of:
+                union = set()
+                for ingredient_id in set(any_of):
+                    union |= self.postings.get(ingredient_id, set())
+                result = union if result is None else result & union
+
+            if none_of and result is not None:
+                for ingredient_id in set(none_of):
+                    result -= self.postings.get(ingredient_id, set())
+
+            return result
+
+    def excluded(self, none_of):
+        """ Meal ids containing at least one of the given ingredients """
+        with self._lock:
+            result = set()
+            for ingredient_id in set(none_of):
+                result |= self.postings.get(ingredient_id, set())
+            return result
+
+    def pantry(self, pantry_ids):
+        """ Returns {meal id: (fraction of its ingredients in the pantry, missing ingredients)}
+        for every meal using at least one pantry ingredient
+        """
+        with self._lock:
+            hits = collections.Counter()
+            for ingredient_id in set(pantry_ids):
+                hits.update(self.postings.get(ingredient_id, ()))
+            return {meal_id: (count / len(self.meals[meal_id]), len(self.meals[meal_id]) - count)
+                    for meal_id, count in hits.items()}
+
+    def ingredients_of(self, meal_ids):
+        """ {meal id: frozenset of its ingredient ids} for the given meals """
+        with self._lock:
+            return {meal_id: frozenset(self.meals.get(meal_id, ())) for meal_id in meal_ids}
+
+    @staticmethod
+    def top(scores, k, candidates=None):
+        """ The k best meal ids of pantry(), best coverage first, then fewest missing ingredients """
+        items = scores.items() if candidates is None else ((x, scores[x]) for x in candidates if x in scores)
+        return [meal_id for meal_id, _ in heapq.nsmallest(k, items, key=lambda x: (-x[1][0], x[1][1], x[0]))]
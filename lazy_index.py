@@ -0,0 +1,36 @@
+""" Base of the in memory indexes
+An index is loaded from the database on first use and kept up to date by the write handlers,
+invalidate() drops it when the data changed some other way, it is loaded again on next use.
+Subclasses implement _load(cur), and skip their incremental updates while not loaded.
+"""
+import abc, threading
+
+
+class LazyIndex(abc.ABC):
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = False
+
+    @abc.abstractmethod
+    def _load(self, cur):
+        """ Builds the index from the database, called with the lock held """
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def load(self, cur):
+        with self._lock:
+            self._load(cur)
+            self._loaded = True
+
+    def ensure_loaded(self, cur):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self.load(cur)
+
+    def invalidate(self):
+        """ Forces a reload on next use """
+        with self._lock:
+            self._loaded = False
@@ -0,0 +1,237 @@
+""" Maintenance jobs, run on a schedule by a background thread or on demand
+    backup  -> consistent copy of the database with sqlite's backup API, readers and writers
+               keep going while it runs, only the last "backup_keep" copies are kept
+    dump    -> meals and ingredients as JSON, one object per line and in a stable order so that
+               dumps diff well, committed when the dump directory is a git repository
+    orphans -> deletes the links to meals or ingredients that no longer exist, in small batches
+    analyze -> refreshes the statistics of the query planner
+    vacuum  -> gives the free pages back to the file system, a few at a time, which needs the
+               database to be in incremental auto_vacuum mode, see vacuum_full()
+Each job returns a report with its duration. When several processes run the application, each
+scheduled run is claimed in the maintenance table so that only one of them does it.
+"""
+import datetime, glob, logging, os, sqlite3, subprocess, threading, time
+import bulk
+
+logger = logging.getLogger(__name__)
+
+JOBS = ("backup", "dump", "orphans", "analyze", "vacuum")
+
+ORPHANS_BATCH_SIZE = 500
+VACUUM_PAGES = 1000
+
+# How often the scheduler looks for jobs to run, in seconds
+CHECK_INTERVAL = 60
+
+
+def backup(conn, directory, keep=7):
+    if keep < 1:
+        raise ValueError("backup_keep should be at least 1, the backup just made is kept.")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "meals-{0}.sqlite".format(datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")))
+    if os.path.exists(path) or os.path.exists(path + ".tmp"):
+        raise FileExistsError("Backup {0} already exists.".format(path))
+    # Written next to its final name then renamed, a backup file is always complete
+    try:
+        destination = sqlite3.connect(path + ".tmp")
+        try:
+            # All pages in one step: a single read transaction, so the copy is consistent
+            conn.backup(destination)
+        finally:
+            destination.close()
+        os.replace(path + ".tmp", path)
+    finally:
+        if os.path.exists(path + ".tmp"):
+            os.remove(path + ".tmp")
+
+    removed = []
+    for old in sorted(glob.glob(os.path.join(directory, "meals-*.sqlite")))[:-keep]:
+        os.remove(old)
+        removed.append(os.path.basename(old))
+    return {"path": path, "bytes": os.path.getsize(path), "removed": removed}
+
+
+def dump(conn, directory):
+    os.makedirs(directory, exist_ok=True)
+    cur = conn.cursor()
+    # One read transaction for both files
+    cur.execute("BEGIN")
+    try:
+        with open(os.path.join(directory, "meals.json"), "w") as f:
+            for chunk in bulk.write_json(_sorted_ingredients(bulk.export_meals(conn.cursor()))):
+                f.write(chunk)
+        with open(os.path.join(directory, "ingredients.json"), "w") as f:
+            # Ingredients used by no meal are only in this file
+            for chunk in bulk.write_json(x[0] for x in cur.execute("SELECT name FROM ingredients ORDER BY name")):
+                f.write(chunk)
+    finally:
+        cur.execute("COMMIT")
+
+    report = {"directory": directory, "committed": False}
+    if os.path.isdir(os.path.join(directory, ".git")):
+        report["committed"] = _git_commit(directory)
+    return report
+
+
+def _sorted_ingredients(meals):
+    for meal in meals:
+        meal["ingredients"].sort()
+        yield meal
+
+
+def _git_commit(directory):
+    def git(*args):
+        return subprocess.run(["git", "-C", directory] + list(args), capture_output=True, text=True)
+
+    git("add", "meals.json", "ingredients.json")
+    if git("diff", "--cached", "--quiet").returncode == 0:
+        return False
+    result = git("commit", "-m", "Meal ideas dump of {0}".format(datetime.date.today().isoformat()))
+    if result.returncode != 0:
+        raise RuntimeError("git commit failed: " + result.stderr.strip())
+    return True
+
+
+def orphans(write, batch_size=ORPHANS_BATCH_SIZE):
+    """ write(function) runs function(cursor) in a write transaction, one per batch
+    so that the writes of the application are never held up for long
+    """
+    def delete_batch(cur):
+        cur.execute("""DELETE FROM meal_ingredients WHERE row_id IN (
+                           SELECT row_id FROM meal_ingredients
+                           WHERE meal_id NOT IN (SELECT id FROM meals)
+                              OR ingredient_id NOT IN (SELECT id FROM ingredients)
+                           LIMIT ?)""", [batch_size])
+        return cur.rowcount
+
+    deleted = 0
+    batches = 0
+    while True:
+        count = write(delete_batch)
+        deleted += count
+        batches += 1
+        if count < batch_size:
+            break
+    return {"deleted": deleted, "batches": batches}
+
+
+def analyze(write):
+    # ANALYZE writes the sqlite_stat tables, it takes the write lock like any write
+    write(lambda cur: cur.execute("ANALYZE"))
+    return {}
+
+
+def vacuum(write, pages=VACUUM_PAGES):
+    def incremental(cur):
+        if cur.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            return None
+        before = free = cur.execute("PRAGMA freelist_count").fetchone()[0]
+        # Through sqlite3 the pragma only runs its first step, which frees a single page
+        while free and before - free < pages:
+            cur.execute("PRAGMA incremental_vacuum(1)")
+            left = cur.execute("PRAGMA freelist_count").fetchone()[0]
+            if left >= free:
+                break
+            free = left
+        return before - free
+
+    freed = write(incremental)
+    if freed is None:
+        return {"freed_pages": 0, "skipped": "auto_vacuum is not incremental, run a full vacuum once"}
+    return {"freed_pages": freed}
+
+
+def vacuum_full(conn):
+    """ Rebuilds the whole database in incremental auto_vacuum mode, blocks writers while it runs """
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    return {}
+
+
+class Maintenance:
+    """ Runs the jobs given an interval in hours in options, see config.py.sample, from a background thread.
+    write(function) runs function(cursor) in a write transaction, on_change() is called
+    after jobs that changed the data.
+    """
+    def __init__(self, pool, options, write, on_change=None):
+        self.pool = pool
+        self.options = options
+        self.write = write
+        self.on_change = on_change
+        self.intervals = {job: hours for job, hours in options.get("intervals", {}).items()
+                          if hours and self.configured(job)}
+
+        self._lock = threading.Lock()
+        self._pid = None
+        self._stop = threading.Event()
+        self.reports = {}
+
+    def configured(self, job):
+        """ Whether job can run, backup and dump need a directory """
+        return job in JOBS and (job != "backup" or bool(self.options.get("backup_dir"))) \
+            and (job != "dump" or bool(self.options.get("dump_dir")))
+
+    def run(self, job):
+        """ Runs a job now, returns its report, with an error key if it failed """
+        if not self.configured(job):
+            raise ValueError("Unknown or unconfigured job: {0}".format(job))
+        start = time.perf_counter()
+        try:
+            if job in ("backup", "dump"):
+                with self.pool.connection() as conn:
+                    if job == "backup":
+                        report = backup(conn, self.options["backup_dir"], self.options.get("backup_keep", 7))
+                    else:
+                        report = dump(conn, self.options["dump_dir"])
+            elif job == "analyze":
+                report = analyze(self.write)
+            elif job == "orphans":
+                report = orphans(self.write, self.options.get("orphans_batch_size", ORPHANS_BATCH_SIZE))
+                if report["deleted"] and self.on_change:
+                    self.on_change()
+            else:
+                report = vacuum(self.write, self.options.get("vacuum_pages", VACUUM_PAGES))
+        except Exception as e:
+            logger.exception("Maintenance job %s failed", job)
+            report = {"error": str(e)}
+
+        report["job"] = job
+        report["finished"] = datetime.datetime.now().isoformat(timespec="seconds")
+        report["seconds"] = round(time.perf_counter() - start, 3)
+        logger.info("Maintenance job %s done in %.3fs", job, report["seconds"])
+        with self._lock:
+            self.reports[job] = report
+        return report
+
+    def _claim(self, job):
+        """ True if this process gets to run job now, False if it ran less than its interval ago """
+        now = time.time()
+        def claim(cur):
+            cur.execute("INSERT INTO maintenance (job, last_run) VALUES (?, 0) ON CONFLICT (job) DO NOTHING", [job])
+            cur.execute("UPDATE maintenance SET last_run = ? WHERE job = ? AND last_run <= ?",
+                        [now, job, now - self.intervals[job] * 3600])
+            return cur.rowcount == 1
+        return self.write(claim)
+
+    def _loop(self):
+        while not self._stop.wait(CHECK_INTERVAL):
+            for job in self.intervals:
+                try:
+                    if self._claim(job):
+                        self.run(job)
+                except Exception:
+                    logger.exception("Couldn't schedule maintenance job %s", job)
+
+    def ensure_started(self):
+        """ Starts the scheduler thread of this process, if any job is scheduled """
+        if self._pid == os.getpid() or not self.intervals:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._loop, name="maintenance", daemon=True).start()
+
+    def stats(self):
+        with self._lock:
+            return {"scheduled": self.intervals, "last": dict(self.reports)}
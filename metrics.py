@@ -0,0 +1,201 @@
+""" Per request instrumentation, exposed in the Prometheus text format
+Each request gets a RequestStats, the cursors of db_cursor() add to it the statements they run,
+their time and the rows they return. When the request ends its totals go to per route histograms.
+Statements slower than a threshold are logged, normalized, with their number of bound parameters.
+Nothing of this runs when metrics are disabled. Every worker process keeps its own figures.
+"""
+import logging, re, sqlite3, threading, time
+
+logger = logging.getLogger(__name__)
+
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+STATEMENT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 200)
+ROW_BUCKETS = (1, 10, 100, 1000, 10000, 100000)
+
+_WHITESPACE = re.compile(r"\s+")
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+_PLACEHOLDER_LISTS = re.compile(r"\?(?:\s*,\s*\?)+")
+
+
+def normalize_sql(sql):
+    """ One line, literals replaced by ?, lists of placeholders collapsed,
+    so that the same statement is logged the same way whatever its arguments
+    """
+    sql = _LITERALS.sub("?", _WHITESPACE.sub(" ", sql).strip())
+    return _PLACEHOLDER_LISTS.sub("?, ...", sql)
+
+
+class RequestStats:
+    __slots__ = ("start", "statements", "sql_time", "rows", "slow_query_time", "slow_queries")
+
+    def __init__(self, slow_query_time):
+        self.start = time.perf_counter()
+        self.statements = 0
+        self.sql_time = 0.0
+        self.rows = 0
+        self.slow_query_time = slow_query_time
+        self.slow_queries = 0
+
+    def cursor(self, conn):
+        """ Cursor factory for connection.cursor() """
+        return Cursor(conn, self)
+
+    def statement(self, sql, binds, elapsed):
+        self.statements += 1
+        self.sql_time += elapsed
+        if elapsed >= self.slow_query_time:
+            self.slow_queries += 1
+            logger.warning("Slow query (%.1fms, %d binds): %s", elapsed * 1000, binds, normalize_sql(sql))
+
+
+class Cursor(sqlite3.Cursor):
+    """ Counts the statements, their time, and the rows read through it.
+    Reading rows is timed too, sqlite runs most of a query while its rows are stepped through.
+    """
+    def __init__(self, conn, stats):
+        super().__init__(conn)
+        self.stats = stats
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.stats.statement(sql, len(parameters), time.perf_counter() - start)
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.stats.statement(sql, sum(len(x) for x in seq_of_parameters), time.perf_counter() - start)
+
+    def _read(self, fetch, *args):
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            self.stats.sql_time += time.perf_counter() - start
+
+    def fetchone(self):
+        row = self._read(super().fetchone)
+        if row is not None:
+            self.stats.rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self._read(super().fetchmany, self.arraysize if size is None else size)
+        self.stats.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._read(super().fetchall)
+        self.stats.rows += len(rows)
+        return rows
+
+    def __next__(self):
+        row = self._read(super().__next__)
+        self.stats.rows += 1
+        return row
+
+
+def _labels(names, values, **extra):
+    pairs = list(zip(names, values)) + list(extra.items())
+    return "{" + ",".join('{0}="{1}"'.format(name, str(value).replace("\\", "\\\\").replace("\"", "\\\"")
+                                             .replace("\n", "\\n")) for name, value in pairs) + "}"
+
+
+class Histogram:
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}       # label values -> [count per bucket..., count, sum]
+
+    def observe(self, values, value):
+        series = self.series.get(values)
+        if series is None:
+            series = self.series[values] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += 1
+        series[-1] += value
+
+    def render(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.help), "# TYPE {0} histogram".format(self.name)]
+        for values, series in sorted(self.series.items()):
+            for bound, count in zip(self.buckets, series):
+                lines.append("{0}_bucket{1} {2}".format(self.name, _labels(self.labels, values, le=bound), count))
+            lines.append("{0}_bucket{1} {2}".format(self.name, _labels(self.labels, values, le="+Inf"), series[-2]))
+            lines.append("{0}_sum{1} {2}".format(self.name, _labels(self.labels, values), series[-1]))
+            lines.append("{0}_count{1} {2}".format(self.name, _labels(self.labels, values), series[-2]))
+        return lines
+
+
+class Counter:
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.series = {}
+
+    def inc(self, values, value=1):
+        self.series[values] = self.series.get(values, 0) + value
+
+    def render(self):
+        lines = ["# HELP {0} {1}".format(self.name, self.help), "# TYPE {0} counter".format(self.name)]
+        for values, count in sorted(self.series.items()):
+            lines.append("{0}{1} {2}".format(self.name, _labels(self.labels, values), count))
+        return lines
+
+
+class Registry:
+    """ Request metrics of this process, by route and method """
+    def __init__(self, slow_query_ms=100):
+        self._lock = threading.Lock()
+        self.slow_query_time = slow_query_ms / 1000
+        labels = ("route", "method")
+        self.requests = Counter("meal_ideas_requests_total", "Requests handled.", labels + ("status",))
+        self.duration = Histogram("meal_ideas_request_duration_seconds", "Wall time of the requests.",
+                                  labels, TIME_BUCKETS)
+        self.statements = Histogram("meal_ideas_request_sql_statements", "SQL statements run per request.",
+                                    labels, STATEMENT_BUCKETS)
+        self.sql_time = Histogram("meal_ideas_request_sql_seconds", "Time spent in sqlite per request.",
+                                  labels, TIME_BUCKETS)
+        self.rows = Histogram("meal_ideas_request_sql_rows", "Rows read from sqlite per request.",
+                              labels, ROW_BUCKETS)
+        self.slow_queries = Counter("meal_ideas_slow_queries_total",
+                                    "Statements slower than the slow query threshold.", labels)
+
+    def start(self):
+        return RequestStats(self.slow_query_time)
+
+    def record(self, route, method, status, stats):
+        labels = (route, method)
+        duration = time.perf_counter() - stats.start
+        with self._lock:
+            self.requests.inc(labels + (str(status),))
+            self.duration.observe(labels, duration)
+            self.statements.observe(labels, stats.statements)
+            self.sql_time.observe(labels, stats.sql_time)
+            self.rows.observe(labels, stats.rows)
+            if stats.slow_queries:
+                self.slow_queries.inc(labels, stats.slow_queries)
+
+    def render(self, gauges=None, counters=None):
+        """ The Prometheus text exposition, gauges and counters are {name: (help, value)} dicts added as is,
+        counter names ending in _total
+        """
+        lines = []
+        with self._lock:
+            for metric in (self.requests, self.duration, self.statements, self.sql_time, self.rows,
+                           self.slow_queries):
+                lines.extend(metric.render())
+        for kind, values in (("gauge", gauges), ("counter", counters)):
+            for name, (help, value) in (values or {}).items():
+                lines.extend(["# HELP {0} {1}".format(name, help), "# TYPE {0} {1}".format(name, kind),
+                              "{0} {1}".format(name, value)])
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,155 @@
+""" Versioned schema migrations
+The schema version is stored in PRAGMA user_version, migrate() applies every migration
+above it in order, each one in its own transaction, then refreshes the planner statistics.
+To change the schema, append a function to MIGRATIONS, never edit one that was released.
+"""
+import logging, time
+
+logger = logging.getLogger(__name__)
+
+
+def _base_schema(cur):
+    # Same as db.sqlite.sample, lets the application start on an empty database
+    cur.execute("""CREATE TABLE IF NOT EXISTS "meals" (
+        "id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT UNIQUE,
+        "title" TEXT NOT NULL,
+        "description" TEXT NOT NULL,
+        "meal_entry" INTEGER NOT NULL DEFAULT 1,
+        "meal_time" INTEGER NOT NULL DEFAULT -1,
+        "season" INTEGER NOT NULL DEFAULT -1,
+        "preparation_time" INTEGER,
+        "cook_time" INTEGER
+    )""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS "ingredients" (
+        "id" INTEGER PRIMARY KEY AUTOINCREMENT,
+        "name" TEXT NOT NULL
+    )""")
+    cur.execute("""CREATE TABLE IF NOT EXISTS "meal_ingredients" (
+        "row_id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
+        "meal_id" INTEGER NOT NULL,
+        "ingredient_id" INTEGER NOT NULL
+    )""")
+
+
+def _unique_constraints(cur):
+    # Duplicated ingredients are merged into the oldest one
+    cur.execute("""UPDATE meal_ingredients SET ingredient_id = (
+                       SELECT min(b.id) FROM ingredients a JOIN ingredients b ON a.name = b.name
+                       WHERE a.id = meal_ingredients.ingredient_id)
+                   WHERE ingredient_id IN (SELECT id FROM ingredients WHERE id NOT IN (
+                       SELECT min(id) FROM ingredients GROUP BY name))""")
+    cur.execute("DELETE FROM ingredients WHERE id NOT IN (SELECT min(id) FROM ingredients GROUP BY name)")
+
+    # Duplicated meals can't be merged safely, the newer ones are renamed
+    cur.execute("""UPDATE meals SET title = title || ' (' || id || ')'
+                   WHERE id NOT IN (SELECT min(id) FROM meals GROUP BY title)""")
+
+    cur.execute("""DELETE FROM meal_ingredients WHERE row_id NOT IN (
+                       SELECT min(row_id) FROM meal_ingredients GROUP BY meal_id, ingredient_id)""")
+
+    cur.execute("CREATE UNIQUE INDEX ingredients_name ON ingredients (name)")
+    cur.execute("CREATE UNIQUE INDEX meals_title ON meals (title)")
+    # Covering in both directions: ingredients of a meal, and meals using an ingredient
+    cur.execute("CREATE UNIQUE INDEX meal_ingredients_meal ON meal_ingredients (meal_id, ingredient_id)")
+    cur.execute("CREATE INDEX meal_ingredients_ingredient ON meal_ingredients (ingredient_id, meal_id)")
+
+
+def _filter_indexes(cur):
+    # total_time lets the total_time_max filter use an index instead of computing the sum on every row
+    cur.execute("""ALTER TABLE meals ADD COLUMN total_time INTEGER
+                   GENERATED ALWAYS AS (cook_time + preparation_time) VIRTUAL""")
+    cur.execute("CREATE INDEX meals_total_time ON meals (total_time)")
+    cur.execute("CREATE INDEX meals_preparation_time ON meals (preparation_time)")
+    cur.execute("CREATE INDEX meals_cook_time ON meals (cook_time)")
+    cur.execute("CREATE INDEX meals_season ON meals (season)")
+    cur.execute("CREATE INDEX meals_meal_time ON meals (meal_time)")
+    # Equality filters first, the planner picks it when meal_entry is given
+    cur.execute("CREATE INDEX meals_entry_time_season ON meals (meal_entry, meal_time, season, total_time)")
+
+
+def _data_generation(cur):
+    # Bumped by every write to the data, lets each process know when its in memory caches are stale
+    cur.execute("CREATE TABLE data_generation (id INTEGER PRIMARY KEY CHECK (id = 0), value INTEGER NOT NULL)")
+    cur.execute("INSERT INTO data_generation (id, value) VALUES (0, 0)")
+    for table in ("meals", "ingredients", "meal_ingredients"):
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            cur.execute("""CREATE TRIGGER {0}_{1}_generation AFTER {2} ON {0} BEGIN
+                               UPDATE data_generation SET value = value + 1 WHERE id = 0;
+                           END""".format(table, event.lower(), event))
+
+
+def _change_log(cur):
+    # Every change to a meal or an ingredient, in order, for clients to sync deltas, see changelog.py.
+    # Changes to the ingredients of a meal are changes of the meal, unless the meal itself was deleted
+    cur.execute("""CREATE TABLE changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        entity TEXT NOT NULL,
+        entity_id INTEGER NOT NULL,
+        op TEXT NOT NULL
+    )""")
+    cur.execute("CREATE INDEX changes_entity ON changes (entity, entity_id, seq)")
+    # Highest seq dropped by compaction, clients that are behind it must resync
+    cur.execute("CREATE TABLE changes_compacted (id INTEGER PRIMARY KEY CHECK (id = 0), seq INTEGER NOT NULL)")
+    cur.execute("INSERT INTO changes_compacted (id, seq) VALUES (0, 0)")
+
+    for table, entity in (("meals", "meal"), ("ingredients", "ingredient")):
+        for event, row in (("INSERT", "new"), ("UPDATE", "new"), ("DELETE", "old")):
+            cur.execute("""CREATE TRIGGER {0}_{1}_changes AFTER {2} ON {0} BEGIN
+                               INSERT INTO changes (entity, entity_id, op) VALUES ('{3}', {4}.id, '{1}');
+                           END""".format(table, event.lower(), event, entity, row))
+    for event, row in (("INSERT", "new"), ("DELETE", "old")):
+        cur.execute("""CREATE TRIGGER meal_ingredients_{0}_changes AFTER {1} ON meal_ingredients
+                       WHEN EXISTS (SELECT 1 FROM meals WHERE id = {2}.meal_id) BEGIN
+                           INSERT INTO changes (entity, entity_id, op) VALUES ('meal', {2}.meal_id, 'update');
+                       END""".format(event.lower(), event, row))
+
+
+def _maintenance(cur):
+    # Last run of each scheduled maintenance job, see maintenance.py, shared by every process
+    cur.execute("CREATE TABLE maintenance (job TEXT PRIMARY KEY, last_run REAL NOT NULL)")
+
+
+MIGRATIONS = [
+    _base_schema,
+    _unique_constraints,
+    _filter_indexes,
+    _data_generation,
+    _change_log,
+    _maintenance
+]
+
+
+def version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    """ Brings the database up to the latest schema version, returns the list of applied versions """
+    applied = []
+    for target, migration in enumerate(MIGRATIONS, start=1):
+        if target <= version(conn):
+            continue
+
+        start = time.perf_counter()
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            # Another process may have migrated while we were waiting for the lock
+            if target <= version(conn):
+                cur.execute("ROLLBACK")
+                continue
+            migration(cur)
+            cur.execute("PRAGMA user_version = {0}".format(target))
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+
+        applied.append(target)
+        logger.info("Applied migration %d (%s) in %.1fms", target, migration.__name__.strip("_"),
+                    (time.perf_counter() - start) * 1000)
+
+    if applied:
+        conn.execute("ANALYZE")
+    conn.execute("PRAGMA optimize")
+    return applied
@@ -0,0 +1,63 @@
+""" Meal plans: a lunch and/or a dinner for each of N days, picked among the candidate meals
+so that no meal comes back and the same ingredients don't come back in consecutive meals.
+Candidates are shuffled once, each slot then takes the first one that shares no ingredient with
+the last meals planned, looking at a bounded number of them, so a plan costs about the same with
+a hundred candidates or with thousands.
+"""
+import collections
+
+SLOTS = {"lunch": 0, "dinner": 1}
+
+# Ingredients of the last WINDOW meals planned are avoided, 4 is two days of lunches and dinners
+WINDOW = 4
+
+# Candidates looked at per slot before settling for the one sharing the fewest ingredients
+TRIES = 64
+
+
+def build(candidates, meal_ingredients, slots, rng, window=WINDOW, tries=TRIES):
+    """ candidates is a list of (meal id, meal_time), meal_ingredients a {meal id: ingredient ids} dict,
+    slots the meal_time of every slot of the plan, in order.
+    Returns the meal id planned for each slot, None when no candidate is left for it.
+    """
+    remaining = list(candidates)
+    rng.shuffle(remaining)
+
+    recent = collections.deque(maxlen=window)
+    recent_counts = collections.Counter()
+    planned = []
+    for slot in slots:
+        best = None
+        best_overlap = None
+        seen = 0
+        for index, (meal_id, meal_time) in enumerate(remaining):
+            if meal_time != -1 and meal_time != slot:
+                continue
+            overlap = sum(recent_counts[x] for x in meal_ingredients.get(meal_id, ()))
+            if best is None or overlap < best_overlap:
+                best, best_overlap = index, overlap
+            seen += 1
+            if overlap == 0 or seen >= tries:
+                break
+
+        if best is None:
+            planned.append(None)
+            continue
+
+        meal_id = remaining.pop(best)[0]
+        planned.append(meal_id)
+        if len(recent) == recent.maxlen:
+            recent_counts.subtract(recent[0])
+        ingredients = meal_ingredients.get(meal_id, ())
+        recent.append(ingredients)
+        recent_counts.update(ingredients)
+    return planned
+
+
+def shopping_list(meal_ids, meal_ingredients):
+    """ {ingredient id: number of planned meals using it} """
+    counts = collections.Counter()
+    for meal_id in meal_ids:
+        if meal_id is not None:
+            counts.update(meal_ingredients.get(meal_id, ()))
+    return counts
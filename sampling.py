@@ -0,0 +1,116 @@
+import collections, datetime, heapq, json, random, threading
+
+# Meals handed out by random mode lately, most recent last, used by the "fresh" weight
+RECENT_SIZE = 200
+_recent = collections.deque(maxlen=RECENT_SIZE)
+_recent_lock = threading.Lock()
+
+# Rejection sampling gives up after this many misses per requested meal and falls back to the id list
+PROBES_PER_PICK = 32
+
+WEIGHTS = ("fresh", "season")
+
+
+def current_season(today=None):
+    """ 0: spring, 1: summer, 2: autumn, 3: winter, same as the meals.season column """
+    month = (today or datetime.date.today()).month
+    return ((month % 12) // 3 + 3) % 4
+
+
+def remember(meal_ids):
+    with _recent_lock:
+        _recent.extend(meal_ids)
+
+
+def _where(conditions):
+    return (" AND " + " AND ".join(conditions)) if conditions else ""
+
+
+def _probe(cur, conditions, arguments, count, candidates=None, excluded=None):
+    """ Draws ids uniformly among candidates, or in [min(id), max(id)] without candidates, and keeps
+    those that exist and match, every probe is a primary key lookup so the cost doesn't depend on the
+    number of matches. conditions must only test columns of the meal, an id list bound to a probe
+    would be rebuilt by sqlite for each one.
+    Returns None when too many probes miss, the caller then falls back to the full id list.
+    """
+    if candidates is None:
+        bounds = cur.execute("SELECT min(id), max(id) FROM meals").fetchone()
+        if bounds[0] is None:
+            return []
+        draw = lambda: random.randint(bounds[0], bounds[1])
+    else:
+        if not candidates:
+            return []
+        draw = lambda: random.choice(candidates)
+
+    # Candidates are meals that exist, they only need checking against the conditions
+    query = "SELECT id FROM meals WHERE id = ? " + _where(conditions) if candidates is None or conditions else None
+    picked = []
+    seen = set()
+    misses = 0
+    while len(picked) < count:
+        candidate = draw()
+        if candidate in seen or (excluded and candidate in excluded) \
+                or (query and not cur.execute(query, [candidate] + arguments).fetchone()):
+            misses += 1
+            if misses > PROBES_PER_PICK * count:
+                return None
+            continue
+        seen.add(candidate)
+        picked.append(candidate)
+    return picked
+
+
+def _weighted(cur, conditions, arguments, count, weight):
+    """ Weighted sampling without replacement (Efraimidis-Spirakis), only ids and seasons are read """
+    query = "SELECT id, season FROM meals"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+
+    if weight == "fresh":
+        with _recent_lock:
+            # 1 for the last suggested meal, RECENT_SIZE for the oldest one remembered
+            age = {meal_id: len(_recent) - i for i, meal_id in enumerate(_recent)}
+
+        def weigh(meal_id, season):
+            if meal_id not in age:
+                return 1.0
+            return 1.0 - 0.95 * (RECENT_SIZE - age[meal_id] + 1) / RECENT_SIZE
+    else:
+        season_now = current_season()
+
+        def weigh(meal_id, season):
+            if season == season_now:
+                return 4.0
+            return 2.0 if season == -1 else 1.0
+
+    keys = ((random.random() ** (1.0 / weigh(meal_id, season)), meal_id)
+            for meal_id, season in cur.execute(query, arguments))
+    return [meal_id for _, meal_id in heapq.nlargest(count, keys)]
+
+
+def sample_meal_ids(cur, conditions, arguments, count=1, weight=None, candidates=None, excluded=None):
+    """ Picks up to count distinct meal ids matching the conditions of a search,
+    without reading or hydrating the meals themselves.
+    Without weight, candidates are the ids to pick from, None for every meal, excluded a set of ids never
+    picked, and conditions must only test columns of the meal. With a weight, every condition is in conditions.
+    """
+    if weight:
+        picked = _weighted(cur, conditions, arguments, count, weight)
+    elif candidates is not None and not conditions and not excluded:
+        picked = random.sample(candidates, min(count, len(candidates)))
+    else:
+        picked = _probe(cur, conditions, arguments, count, candidates, excluded)
+        if picked is None:
+            # Every match is read once, id lists are given to sqlite in a single statement
+            if candidates is not None:
+                conditions = [" meals.id IN (SELECT value FROM json_each(?)) "] + conditions
+                arguments = [json.dumps(candidates)] + arguments
+            query = "SELECT id FROM meals"
+            if conditions:
+                query += " WHERE " + " AND ".join(conditions)
+            ids = [x[0] for x in cur.execute(query, arguments) if not excluded or x[0] not in excluded]
+            picked = random.sample(ids, min(count, len(ids)))
+
+    remember(picked)
+    return picked
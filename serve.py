@@ -0,0 +1,64 @@
+""" Production server
+    python serve.py [--bind 0.0.0.0:8000] [--workers 4] [--threads 2]
+Runs the application with gunicorn, several worker processes each with a few threads,
+or with waitress, one process with several threads, if gunicorn isn't installed.
+Defaults come from the "server" entry of config.py, the number of workers defaults to the number of cores.
+"""
+import argparse, importlib.util, multiprocessing
+from config import params
+
+
+def run_gunicorn(bind, workers, threads):
+    from gunicorn.app.base import BaseApplication
+
+    class Server(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", bind)
+            self.cfg.set("workers", workers)
+            self.cfg.set("threads", threads)
+            # The application, and its migrations, are loaded once in the master process
+            self.cfg.set("preload_app", True)
+            self.cfg.set("when_ready", when_ready)
+
+        def load(self):
+            from application import app, pool
+            pool.max_idle = max(pool.max_idle, threads)
+            return app
+
+    def when_ready(server):
+        # Workers open their own connections after the fork
+        from application import pool
+        pool.close()
+
+    Server().run()
+
+
+def run_waitress(bind, threads):
+    import waitress
+    from application import app, pool
+    pool.max_idle = max(pool.max_idle, threads)
+    waitress.serve(app, listen=bind, threads=threads)
+
+
+def main():
+    server = params.get("server", {})
+    parser = argparse.ArgumentParser(description="Runs the meal ideas application.")
+    parser.add_argument("--bind", default=server.get("bind", "0.0.0.0:8000"), help="host:port to listen on")
+    parser.add_argument("--workers", type=int, default=server.get("workers", multiprocessing.cpu_count()),
+                        help="worker processes, gunicorn only")
+    parser.add_argument("--threads", type=int, default=server.get("threads", 2), help="threads per worker")
+    args = parser.parse_args()
+
+    if not params.get("secret_key"):
+        parser.error("Set secret_key in config.py, workers must share it to keep users logged in.")
+
+    if importlib.util.find_spec("gunicorn"):
+        run_gunicorn(args.bind, args.workers, args.threads)
+    elif importlib.util.find_spec("waitress"):
+        run_waitress(args.bind, args.threads)
+    else:
+        parser.error("Install gunicorn (or waitress, single process) to run the production server.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+""" Similar meals, by the Jaccard similarity of their ingredient sets
+Each meal gets a MinHash signature of its ingredient ids: the probability that two signatures agree on
+a position is the Jaccard similarity of the two sets. Signatures are cut in BANDS bands of ROWS values,
+meals agreeing on a whole band land in the same bucket, so that the meals looked at for a query are
+only those sharing a bucket with it, likely the most similar ones, instead of the whole catalog.
+Candidates are then ranked by their exact Jaccard similarity.
+"""
+import collections, heapq, random
+from lazy_index import LazyIndex
+
+BANDS = 16
+ROWS = 3
+# Meals with a similarity of about (1 / BANDS) ** (1 / ROWS), 0.4, have even chances of sharing a bucket
+SIGNATURE_SIZE = BANDS * ROWS
+
+# Below 2 ** 30, hash values stay single digit ints, much faster to compare and hash
+_PRIME = 1073741789
+_random = random.Random(0)
+_COEFFICIENTS = [(_random.randrange(1, _PRIME), _random.randrange(_PRIME)) for _ in range(SIGNATURE_SIZE)]
+
+
+def jaccard(a, b):
+    if not a and not b:
+        return 0.0
+    common = len(a & b)
+    return common / (len(a) + len(b) - common)
+
+
+class SimilarityIndex(LazyIndex):
+    def __init__(self):
+        super().__init__()
+        self._hashes = {}      # ingredient id -> its SIGNATURE_SIZE hash values
+        self._clear()
+
+    def _clear(self):
+        self.meals = {}        # meal id -> frozenset of ingredient ids
+        self.signatures = {}   # meal id -> signature
+        self.buckets = [collections.defaultdict(set) for _ in range(BANDS)]   # band -> band values -> meal ids
+
+    def _ingredient_hashes(self, ingredient_id):
+        hashes = self._hashes.get(ingredient_id)
+        if hashes is None:
+            hashes = self._hashes[ingredient_id] = tuple((a * ingredient_id + b) % _PRIME for a, b in _COEFFICIENTS)
+        return hashes
+
+    def signature(self, ingredient_ids):
+        hashes = [self._ingredient_hashes(x) for x in ingredient_ids]
+        if len(hashes) == 1:
+            return hashes[0]
+        return tuple(map(min, *hashes))
+
+    @staticmethod
+    def _bands(signature):
+        return [signature[band * ROWS:(band + 1) * ROWS] for band in range(BANDS)]
+
+    def _load(self, cur):
+        meals = collections.defaultdict(set)
+        for meal_id, ingredient_id in cur.execute("SELECT meal_id, ingredient_id FROM meal_ingredients"):
+            meals[meal_id].add(ingredient_id)
+
+        self._clear()
+        for meal_id, ingredient_ids in meals.items():
+            self._add(meal_id, ingredient_ids)
+
+    def _add(self, meal_id, ingredient_ids):
+        signature = self.signature(ingredient_ids)
+        self.meals[meal_id] = frozenset(ingredient_ids)
+        self.signatures[meal_id] = signature
+        for buckets, key in zip(self.buckets, self._bands(signature)):
+            buckets[key].add(meal_id)
+
+    def add_meal(self, meal_id, ingredient_ids):
+        with self._lock:
+            if not self._loaded:
+                return
+            self.remove_meal(meal_id)
+            if ingredient_ids:
+                self._add(meal_id, ingredient_ids)
+
+    def remove_meal(self, meal_id):
+        with self._lock:
+            signature = self.signatures.pop(meal_id, None)
+            self.meals.pop(meal_id, None)
+            if signature is None:
+                return
+            for buckets, key in zip(self.buckets, self._bands(signature)):
+                bucket = buckets.get(key)
+                if bucket is not None:
+                    bucket.discard(meal_id)
+                    if not bucket:
+                        del buckets[key]
+
+    def remove_ingredient(self, ingredient_id, meal_ids):
+        """ meal_ids are the meals that had the ingredient, from IngredientIndex.remove_ingredient(),
+        None when unknown, the index is then loaded again on next use
+        """
+        with self._lock:
+            if not self._loaded:
+                return
+            if meal_ids is None:
+                self._loaded = False
+                return
+            for meal_id in meal_ids:
+                if meal_id in self.meals:
+                    self.add_meal(meal_id, self.meals[meal_id] - {ingredient_id})
+
+    def similar(self, meal_id, k):
+        """ The approximate k most similar meals, as [(meal id, similarity)], most similar first """
+        with self._lock:
+            signature = self.signatures.get(meal_id)
+            if signature is None:
+                return []
+            candidates = set()
+            for buckets, key in zip(self.buckets, self._bands(signature)):
+                candidates |= buckets.get(key, set())
+            candidates.discard(meal_id)
+            return self._top(meal_id, candidates, k)
+
+    def similar_exact(self, meal_id, k):
+        """ Same as similar(), comparing the meal to every other one """
+        with self._lock:
+            if meal_id not in self.meals:
+                return []
+            return self._top(meal_id, [x for x in self.meals if x != meal_id], k)
+
+    def _top(self, meal_id, candidates, k):
+        ingredients = self.meals[meal_id]
+        scores = ((jaccard(ingredients, self.meals[x]), x) for x in candidates)
+        return [(x, score) for score, x in heapq.nsmallest(k, scores, key=lambda item: (-item[0], item[1]))
+                if score > 0]
@@ -0,0 +1,214 @@
+""" Single writer with group commit
+Request handlers submit their writes, functions of a cursor, to one writer thread with its own
+connection. The writer takes every write waiting in its queue, and those arriving within a short
+window, and runs them in a single transaction, each one in a savepoint so that a failing write only
+undoes itself. A commit, and its fsync, is then paid once for many writes, and writes of a process
+never wait on each other's locks. Reads don't go through the writer, they keep using their own
+connections and WAL snapshots.
+"""
+import atexit, logging, os, queue, threading, time
+import database
+
+logger = logging.getLogger(__name__)
+
+
+class _Job:
+    __slots__ = ("function", "result", "error", "done", "abandoned")
+
+    def __init__(self, function):
+        self.function = function
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        # Set when the submitter stopped waiting, the write may still be committed after that
+        self.abandoned = False
+
+
+class Writer:
+    def __init__(self, pool, transaction=database.transaction, window_ms=1, max_batch=64, after_commit=None,
+                 timeout=30, on_abandoned=None):
+        """ transaction is the context manager the writes of a batch run in, given a cursor,
+        after_commit(cursor) is called once their submitters have their results, its errors are only logged,
+        timeout is how long, in seconds, a submitter waits for its write,
+        on_abandoned() is called after a commit including writes whose submitters stopped waiting
+        """
+        self.pool = pool
+        self.transaction = transaction
+        self.after_commit = after_commit
+        self.on_abandoned = on_abandoned
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._batch = []
+        self._stats = {
+            "commits": 0,
+            "writes": 0,
+            "failed": 0,
+            "max_batch": 0,
+            "commit_time": 0.0,
+            "max_commit_time": 0.0,
+            "last_commit_time": 0.0
+        }
+
+    def _ensure_started(self):
+        # Threads don't survive a fork, each process starts its own writer on first use
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._run, args=(self._queue,), name="writer", daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def submit(self, function):
+        """ Runs function(cursor) in a write transaction of the writer thread, returns its result
+        once committed, or raises the exception it raised, its writes being rolled back.
+        Raises TimeoutError after timeout seconds, the write may then still be committed later.
+        """
+        self._ensure_started()
+        job = _Job(function)
+        self._queue.put(job)
+        if not job.done.wait(self.timeout):
+            with self._lock:
+                # Jobs are marked done under the lock, a write committed meanwhile is returned as usual
+                job.abandoned = not job.done.is_set()
+            if job.abandoned:
+                raise TimeoutError("The write wasn't committed within {0}s, it may still be.".format(self.timeout))
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _run(self, jobs_queue):
+        conn = None
+        try:
+            conn = self.pool.acquire()
+            self._serve(conn.cursor(), jobs_queue)
+        except BaseException as e:
+            logger.exception("The writer thread stopped")
+            self._crashed(jobs_queue, e)
+        finally:
+            if conn is not None:
+                self.pool.release(conn)
+
+    def _crashed(self, jobs_queue, exception):
+        """ Fails the writes in flight and those waiting, the next submit() starts a new thread """
+        with self._lock:
+            if self._queue is jobs_queue:
+                self._pid = None
+        error = RuntimeError("The writer thread stopped: {0}".format(exception))
+        jobs = self._batch
+        while True:
+            try:
+                jobs.append(jobs_queue.get_nowait())
+            except queue.Empty:
+                break
+        for job in jobs:
+            if job is not None and not job.done.is_set():
+                job.error = error
+                job.done.set()
+
+    def _serve(self, cur, jobs_queue):
+        while True:
+            job = jobs_queue.get()
+            if job is None:
+                break
+            jobs = self._batch = [job]
+            deadline = time.perf_counter() + self.window
+            while len(jobs) < self.max_batch:
+                try:
+                    # What is already waiting is taken at once, then the window is waited
+                    job = jobs_queue.get_nowait()
+                except queue.Empty:
+                    timeout = deadline - time.perf_counter()
+                    if timeout <= 0:
+                        break
+                    try:
+                        job = jobs_queue.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                if job is None:
+                    jobs_queue.put(None)
+                    break
+                jobs.append(job)
+            self._commit(cur, jobs)
+            self._batch = []
+
+    def _commit(self, cur, jobs):
+        start = time.perf_counter()
+        try:
+            with self.transaction(cur):
+                for job in jobs:
+                    try:
+                        # Nested in the batch transaction, a savepoint
+                        with database.transaction(cur):
+                            job.result = job.function(cur)
+                    except Exception as e:
+                        job.error = e
+        except Exception as e:
+            # BEGIN or COMMIT failed and the transaction was rolled back, none of the writes happened
+            for job in jobs:
+                job.error = e
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self._stats["commits"] += 1
+            self._stats["writes"] += len(jobs)
+            self._stats["failed"] += sum(1 for job in jobs if job.error is not None)
+            self._stats["max_batch"] = max(self._stats["max_batch"], len(jobs))
+            self._stats["commit_time"] += elapsed
+            self._stats["max_commit_time"] = max(self._stats["max_commit_time"], elapsed)
+            self._stats["last_commit_time"] = elapsed
+            for job in jobs:
+                job.done.set()
+            abandoned = any(job.abandoned and job.error is None for job in jobs)
+
+        if abandoned and self.on_abandoned is not None:
+            try:
+                self.on_abandoned()
+            except Exception:
+                logger.exception("Handling the abandoned writes failed")
+
+        if self.after_commit is not None:
+            try:
+                self.after_commit(cur)
+            except Exception:
+                logger.exception("After commit work of the writer failed")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        commit_time = stats.pop("commit_time")
+        stats["queue_depth"] = self._queue.qsize() if self._queue is not None and self._pid == os.getpid() else 0
+        stats["mean_batch"] = round(stats["writes"] / stats["commits"], 2) if stats["commits"] else 0
+        stats["mean_commit_ms"] = round(commit_time / stats["commits"] * 1000, 3) if stats["commits"] else 0
+        stats["max_commit_ms"] = round(stats.pop("max_commit_time") * 1000, 3)
+        stats["last_commit_ms"] = round(stats.pop("last_commit_time") * 1000, 3)
+        return stats
+
+    def close(self):
+        """ Lets the writes already submitted finish, then stops the thread """
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+            self._queue.put(None)
+            thread = self._thread
+            self._pid = None
+        thread.join(timeout=10)
+
+
+def create_writer(pool, params, transaction=database.transaction, after_commit=None, on_abandoned=None):
+    writer = Writer(pool, transaction,
+                    window_ms=params.get("writer_window_ms", 1),
+                    max_batch=params.get("writer_max_batch", 64),
+                    after_commit=after_commit,
+                    timeout=params.get("writer_timeout", 30),
+                    on_abandoned=on_abandoned)
+    atexit.register(writer.close)
+    return writer